@@ -14,5 +14,7 @@ import askci.apps.base.views as views
 urlpatterns = [
     url(r"^search/?$", views.search_view, name="search"),
     url(r"^searching/?$", views.run_search, name="running_search"),
+    url(r"^search/results/?$", views.search_results, name="search_results"),
+    url(r"^search/suggest/?$", views.search_suggestions, name="search_suggestions"),
     url(r"^search/(?P<query>.+?)/?$", views.search_view, name="search_query"),
 ]
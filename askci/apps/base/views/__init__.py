@@ -2,4 +2,4 @@ from .errors import handler404, handler500
 
 from .main import about_view, index_view, contact_view, privacy_view, terms_view
 
-from .search import run_search, search_view
+from .search import run_search, search_results, search_suggestions, search_view
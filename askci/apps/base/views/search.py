@@ -8,19 +8,71 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 """
 
-from django.db.models import Q
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    TrigramSimilarity,
+)
+from django.db.models import CharField, F, IntegerField, Value
+from django.http import JsonResponse
 from django.shortcuts import render
 from ratelimit.decorators import ratelimit
 
 from askci.apps.main.models import Article, Question, Tag
+from askci.apps.main.search import (
+    get_cached_search,
+    get_suggestions,
+    normalize_query,
+    set_similarity,
+    suggest_query,
+)
+from askci.settings import (
+    SEARCH_CONFIG,
+    SEARCH_MAX_RESULTS,
+    SEARCH_PAGE_SIZE,
+    SEARCH_SUGGEST_LIMIT,
+    SEARCH_SUGGEST_RATE_LIMIT,
+)
 from askci.settings import VIEW_RATE_LIMIT as rl_rate, VIEW_RATE_LIMIT_BLOCK as rl_block
 
-from itertools import chain
+import base64
+import binascii
+import json
 
 
 # General Search ###############################################################
 
 
+def get_search_args(request):
+    """return the query types, fuzzy flag, and cursor from request.GET
+    """
+    return {
+        "query_types": request.GET.get("type"),
+        "fuzzy": request.GET.get("fuzzy") is not None,
+        "cursor": request.GET.get("cursor"),
+    }
+
+
+def get_search_context(request, query):
+    """run a search for the first (or cursor) page of results, along with
+       a "did you mean" suggestion if an exact search found nothing.
+    """
+    args = get_search_args(request)
+    page = askci_query(query, request=request, **args)
+    context = {
+        "results": page["results"],
+        "next": page["next"],
+        "query": query,
+        "fuzzy": args["fuzzy"],
+        "submit_result": "anything",
+    }
+    if not page["results"] and not args["fuzzy"] and not args["cursor"]:
+        context["suggestion"] = get_cached_search(
+            {"suggest": normalize_query(query)}, lambda: suggest_query(query)
+        )
+    return context
+
+
 @ratelimit(key="ip", rate=rl_rate, block=rl_block)
 def search_view(request, query=None):
     """this is the base search view if the user goes to the page 
@@ -33,11 +85,8 @@ def search_view(request, query=None):
     if query is None:
         query = request.GET.get("q")
 
-    query_type = request.GET.get("type")
-
     if query is not None:
-        results = askci_query(query, query_type, request=request)
-        context["results"] = results
+        context = get_search_context(request, query)
     return render(request, "search/search.html", context)
 
 
@@ -51,58 +100,221 @@ def run_search(request):
         q = request.GET.get("q")
 
     if q is not None:
-        results = askci_query(q, request=request)
-        context = {"results": results, "submit_result": "anything"}
-        return render(request, "search/result.html", context)
+        return render(request, "search/result.html", get_search_context(request, q))
+
+
+@ratelimit(key="ip", rate=rl_rate, block=rl_block)
+def search_results(request):
+    """return a page of search results as json, ordered by score. The
+       response includes a cursor for the next page (null on the last page),
+       to pass back as ?cursor=
+    """
+    q = request.GET.get("q")
+    if not q:
+        return JsonResponse({"message": "A query (q) is required."}, status=400)
+
+    page = askci_query(q, request=request, **get_search_args(request))
+    results = [
+        {
+            "label": result.get_label(),
+            "uuid": str(result.uuid),
+            "name": getattr(result, "name", None) or str(result),
+            "url": request.build_absolute_uri(result.get_absolute_url()),
+            "score": result.score,
+        }
+        for result in page["results"]
+    ]
+    return JsonResponse({"query": q, "results": results, "next": page["next"]})
+
+
+@ratelimit(key="ip", rate=SEARCH_SUGGEST_RATE_LIMIT, block=rl_block)
+def search_suggestions(request):
+    """return typeahead suggestions (article names, tags, and questions) for
+       what has been typed in the search box as json, from the prefix index
+       in redis.
+    """
+    q = request.GET.get("q", "")
+    try:
+        limit = int(request.GET.get("limit", SEARCH_SUGGEST_LIMIT))
+    except ValueError:
+        limit = SEARCH_SUGGEST_LIMIT
+    return JsonResponse({"query": q, "suggestions": get_suggestions(q, max(limit, 1))})
 
 
 # Search Function ##############################################################
 
 
 def articles_query(q):
-    """specific search for articles
+    """specific search for articles, using the search vector (name, tags,
+       summary, and text) maintained at ingest. Results are ordered by
+       rank, with matches in names and tags weighted above the text.
     """
-    return Article.objects.filter(
-        Q(name__icontains=q)
-        | Q(namespace__icontains=q)
-        | Q(text__icontains=q)
-        | Q(tags__tag__icontains=q)
-        | Q(summary__icontains=q)
-    ).distinct()
+    query = SearchQuery(q, config=SEARCH_CONFIG)
+    return (
+        Article.objects.filter(search=query)
+        .annotate(score=SearchRank(F("search"), query))
+        .order_by("-score")
+    )
 
 
 def questions_query(q):
-    """specific search for questions
+    """specific search for questions, ordered by similarity to the query
+       (the trigram index is used for the containment match too)
     """
-    return Question.objects.filter(Q(text__icontains=q)).distinct()
+    return (
+        Question.objects.filter(text__icontains=q)
+        .annotate(score=TrigramSimilarity("text", q))
+        .order_by("-score")
+    )
 
 
 def tags_query(q):
-    """specific search for tags
+    """specific search for tags, ordered by similarity to the query
     """
-    return Tag.objects.filter(Q(tag__icontains=q)).distinct()
+    return (
+        Tag.objects.filter(tag__icontains=q)
+        .annotate(score=TrigramSimilarity("tag", q))
+        .order_by("-score")
+    )
 
 
-def askci_query(q, query_types=None, request=None):
-    """run a general query across questions, articles, and tags.
+def fuzzy_articles_query(q):
+    """fuzzy search for articles with a name similar to the query
     """
+    return (
+        Article.objects.filter(name__trigram_similar=q)
+        .annotate(score=TrigramSimilarity("name", q))
+        .order_by("-score")
+    )
+
+
+def fuzzy_questions_query(q):
+    """fuzzy search for questions with words similar to the query
+    """
+    return (
+        Question.objects.filter(text__trigram_word_similar=q)
+        .annotate(score=TrigramSimilarity("text", q))
+        .order_by("-score")
+    )
+
+
+def fuzzy_tags_query(q):
+    """fuzzy search for tags similar to the query
+    """
+    return (
+        Tag.objects.filter(tag__trigram_similar=q)
+        .annotate(score=TrigramSimilarity("tag", q))
+        .order_by("-score")
+    )
+
+
+def encode_cursor(offset):
+    """return an opaque cursor for the page of results at an offset
+    """
+    cursor = json.dumps({"offset": offset}).encode("utf-8")
+    return base64.urlsafe_b64encode(cursor).decode("utf-8")
+
+
+def decode_cursor(cursor):
+    """return the offset for a cursor, or 0 if it isn't valid
+    """
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))
+        return max(int(offset["offset"]), 0)
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        return 0
+
+
+def askci_query(
+    q, query_types=None, request=None, fuzzy=False, cursor=None, per_page=None
+):
+    """run a general query across questions, articles, and tags, and return
+       a page of results (with a score) ordered by score, and a cursor for
+       the next page. Full text article matches are ranked with ts_rank,
+       and the rest with trigram similarity, which isn't comparable, so
+       full text matches come first. The types are merged and ordered in the database
+       with a UNION and LIMIT, so only one page of rows is read no matter
+       how many match. Results past SEARCH_MAX_RESULTS aren't paged, and
+       pages are cached until articles change. A fuzzy query matches
+       misspellings using trigram similarity instead.
+    """
+    # The model, query, and tier (scores are only compared within a tier)
     searches = {
-        "articles": articles_query,
-        "questions": questions_query,
-        "tags": tags_query,
+        "articles": (Article, articles_query, 0),
+        "questions": (Question, questions_query, 1),
+        "tags": (Tag, tags_query, 1),
     }
+    if fuzzy:
+        searches = {
+            "articles": (Article, fuzzy_articles_query, 0),
+            "questions": (Question, fuzzy_questions_query, 0),
+            "tags": (Tag, fuzzy_tags_query, 0),
+        }
 
     # If the user doesn't provide one or more types, search all
     if not query_types:
         query_types = list(searches.keys())
     else:
         query_types = query_types.split(",")
+    query_types = [query_type for query_type in searches if query_type in query_types]
+
+    page = {"results": [], "next": None}
+    per_page = min(per_page or SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE)
+    offset = decode_cursor(cursor) if cursor else 0
+    if not query_types or offset >= SEARCH_MAX_RESULTS:
+        return page
 
-    skips = []
+    # The label, uuid, and score of each match on the page (and one more, to
+    # know if there is a next page), cached until articles change
+    def search():
+        if fuzzy:
+            set_similarity()
+        matches = [
+            searches[query_type][1](q)
+            .order_by()
+            .annotate(
+                type=Value(query_type, output_field=CharField()),
+                tier=Value(searches[query_type][2], output_field=IntegerField()),
+            )
+            .values_list("type", "uuid", "score", "tier")
+            for query_type in query_types
+        ]
+        query = matches[0].union(*matches[1:], all=True)
+        query = query.order_by("tier", "-score", "type", "uuid")
+        return [
+            [query_type, str(uuid), score]
+            for query_type, uuid, score, _ in query[offset : offset + per_page + 1]
+        ]
+
+    params = {
+        "q": normalize_query(q),
+        "types": query_types,
+        "fuzzy": fuzzy,
+        "offset": offset,
+        "per_page": per_page,
+    }
+    rows = get_cached_search(params, search)
+    if len(rows) > per_page and offset + per_page < SEARCH_MAX_RESULTS:
+        page["next"] = encode_cursor(offset + per_page)
+    rows = rows[:per_page]
 
-    results = []
+    # Load only the objects on the page
+    objects = {}
     for query_type in query_types:
-        if query_type in searches and query_type not in skips:
-            results = list(chain(results, searches[query_type](q)))
+        model = searches[query_type][0]
+        uuids = [row[1] for row in rows if row[0] == query_type]
+        if not uuids:
+            continue
+        queryset = model.objects.filter(uuid__in=uuids)
+        if model == Article:
+            queryset = queryset.prefetch_related("tags")
+        elif model == Question:
+            queryset = queryset.select_related("article")
+        objects[query_type] = {str(result.uuid): result for result in queryset}
 
-    return results
+    for query_type, uuid, score in rows:
+        result = objects[query_type].get(uuid)
+        if result is not None:
+            result.score = score
+            page["results"].append(result)
+    return page
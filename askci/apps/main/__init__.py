@@ -0,0 +1 @@
+default_app_config = "askci.apps.main.apps.MainAppConfig"
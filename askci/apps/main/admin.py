@@ -9,7 +9,13 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """
 
 from django.contrib import admin
-from askci.apps.main.models import Article, Question, Tag, TemplateRepository
+from askci.apps.main.models import (
+    Article,
+    Question,
+    Tag,
+    TemplateRepository,
+    TemplateUpdate,
+)
 
 
 class ArticleAdmin(admin.ModelAdmin):
@@ -28,7 +34,27 @@ class TemplateRepositoryAdmin(admin.ModelAdmin):
     list_display = ("repo",)
 
 
+def resume_template_updates(modeladmin, request, queryset):
+    """submit a job to continue each template update (e.g., after a worker
+       restart), which skips articles that were already updated.
+    """
+    from askci.apps.main.github import start_template_update
+
+    for update in queryset.exclude(status="finished"):
+        start_template_update(update.uuid)
+
+
+resume_template_updates.short_description = "Resume selected template updates"
+
+
+class TemplateUpdateAdmin(admin.ModelAdmin):
+    list_display = ("uuid", "owner", "status", "progress", "created", "modified")
+    readonly_fields = ("status", "owner", "articles", "results")
+    actions = [resume_template_updates]
+
+
 admin.site.register(TemplateRepository, TemplateRepositoryAdmin)
 admin.site.register(Article, ArticleAdmin)
 admin.site.register(Question, QuestionAdmin)
 admin.site.register(Tag, TagAdmin)
+admin.site.register(TemplateUpdate, TemplateUpdateAdmin)
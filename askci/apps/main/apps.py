@@ -1,5 +1,18 @@
 from django.apps import AppConfig
+from django.db.models import CharField, TextField
+from django.db.models.signals import pre_migrate
 
 
 class MainAppConfig(AppConfig):
-    name = "main"
+    name = "askci.apps.main"
+    label = "main"
+
+    def ready(self):
+        from askci.apps.main.search import (
+            TrigramWordSimilar,
+            create_trigram_extension,
+        )
+
+        CharField.register_lookup(TrigramWordSimilar)
+        TextField.register_lookup(TrigramWordSimilar)
+        pre_migrate.connect(create_trigram_extension, sender=self)
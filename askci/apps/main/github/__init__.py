@@ -8,18 +8,31 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 """
 
+from django.db import connection
 from django.views.decorators.csrf import csrf_exempt
 from django.urls import reverse
 
 import django_rq
 
-from askci.apps.main.tasks import repository_change, update_article, update_pullrequest
 from askci.apps.users.models import User
-from askci.apps.main.models import Article
-from askci.settings import DISABLE_WEBHOOKS, DOMAIN_NAME
+from askci.apps.users.utils import get_social_auth
+from askci.apps.main.models import Article, TemplateUpdate
+from askci.apps.main.utils import get_redis
+from askci.settings import (
+    DISABLE_WEBHOOKS,
+    DOMAIN_NAME,
+    GITHUB_API_BASE,
+    TEMPLATE_UPDATE_BATCH_SIZE,
+    TEMPLATE_UPDATE_RATE,
+    TEMPLATE_UPDATE_WORKERS,
+)
 
+from .budget import defer_if_exhausted, get_budget_wait
+from .client import get_client
+from .events import accept_webhook, get_webhook_article
 from .utils import (
     check_headers,
+    conditional_get,
     get_default_headers,
     JsonResponseMessage,
     load_body,
@@ -29,13 +42,17 @@ from .utils import (
     POST,
 )
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from redis.exceptions import LockError
 import re
-import requests
+import time
 import uuid
-import json
 
-api_base = "https://api.github.com"
+api_base = GITHUB_API_BASE.rstrip("/")
+
+# The current batch chain and a lock for each template update
+template_update_prefix = "askci:template:update"
 
 
 ## Authentication
@@ -74,17 +91,38 @@ def get_auth_token(user):
        ==========
        user: a user object
     """
+    credentials = get_social_auth(user)
+
     # 1. Github with repo permissions first priority
-    auth = [x for x in user.social_auth.all() if x.provider == "github"]
+    auth = [x for x in credentials if x.provider == "github"]
 
     # 2. Github public second priority
     if not auth:
-        auth = [x for x in user.social_auth.all() if x.provider == "github-readonly"]
+        auth = [x for x in credentials if x.provider == "github-readonly"]
 
     if auth:
         return auth[0].access_token
 
 
+def defer_for_budget(user, func, **kwargs):
+    """background jobs that use a user's credentials call this first. If the
+       user's GitHub budget is below the reserve, the job is scheduled again
+       for after the rate limit resets, and we return True.
+    """
+    if user is None:
+        return False
+    return defer_if_exhausted(get_auth_token(user), func, **kwargs)
+
+
+def get_user_budget_wait(user):
+    """return the seconds a background job using a user's credentials should
+       wait for the rate limit to reset, or 0, without scheduling anything.
+    """
+    if user is None:
+        return 0
+    return get_budget_wait(get_auth_token(user))
+
+
 # Meta
 
 
@@ -93,7 +131,7 @@ def get_meta():
        servers. See https://developer.github.com/v3/meta/
     """
     url = "%s/meta" % api_base
-    response = requests.get(url)
+    response = conditional_get(url)
     if response.status_code == 200:
         return response.json()
 
@@ -116,13 +154,13 @@ def get_repo(user, reponame, username, headers=None):
         headers = get_auth(user)
     headers["Accept"] = "application/vnd.github.mercy-preview+json"
     url = "%s/repos/%s/%s" % (api_base, username, reponame)
-    response = requests.get(url, headers=headers)
+    response = conditional_get(url, headers=headers)
 
     # Case 2: public and private
     if response.status_code != 200:
         auth_headers = get_auth(user, idx=1)
         headers.update(auth_headers)
-        response = requests.get(url, headers=headers)
+        response = conditional_get(url, headers=headers)
     response = response.json()
     return response
 
@@ -135,7 +173,7 @@ def get_admin_namespaces(user):
     headers = get_auth(user)
 
     url = "%s/user/memberships/orgs" % api_base
-    response = requests.get(url, headers=headers)
+    response = conditional_get(url, headers=headers)
 
     for org in response.json():
         if org["role"] == "admin":
@@ -157,7 +195,7 @@ def get_namespaces(user):
     # this url is supposed to return public/private but doens't seem to work
     # url = "%s/user/orgs" % api_base
     url = "%s/users/%s/orgs" % (api_base, user.username)
-    response = requests.get(url, headers=headers)
+    response = conditional_get(url, headers=headers)
 
     # User can create for personal repo, not org
     if response.status_code in [401, 403]:
@@ -187,7 +225,7 @@ def open_issue(user, article, title, summary):
 
     # Data should include updated markdown (for README)
     url = "%s/repos/%s/issues" % (api_base, article.repo["full_name"])
-    response = requests.post(url, headers=headers, json=data)
+    response = get_client().post(url, headers=headers, json=data)
 
     return response.json()
 
@@ -218,26 +256,35 @@ def request_review(user, article, markdown):
 
     # Data should include updated markdown (for README)
     url = "%s/repos/%s/dispatches" % (api_base, article.repo["full_name"])
-    response = requests.post(url, headers=headers, json=data)
+    response = get_client().post(url, headers=headers, json=data)
     return response.status_code
 
 
-def update_template(article):
+def update_template(article, defer=True):
     """Each article has an upstream template, and to update it we need to
        trigger a dispatch event that will obtain updated files from the
        template, and then open a pull request to the repository owner.
+       Returns the status code of the dispatch, or why it wasn't sent.
+       If the owner's rate limit is low, the update is scheduled for after
+       the reset, unless defer is False (run_template_update retries it).
     """
     # If it's run as a task, we get a string
     if isinstance(article, str):
         try:
             article = Article.objects.get(name=article)
         except Article.DoesNotExist:
-            return
+            return "not found"
 
     # Must be authenticated with GitHub create? (need to check this)
     if not article.owner.has_github_create():
         article.archive("we could not trigger a dispatch event. ")
-        return
+        return "archived"
+
+    # Wait for the rate limit to reset if interactive requests need it
+    if not defer and get_user_budget_wait(article.owner):
+        return "deferred"
+    if defer and defer_for_budget(article.owner, update_template, article=article.name):
+        return "deferred"
 
     # Replace all "\r\n" with just \n
     headers = get_auth(article.owner)
@@ -254,10 +301,117 @@ def update_template(article):
 
     # Data should include updated markdown (for README)
     url = "%s/repos/%s/dispatches" % (api_base, article.repo["full_name"])
-    response = requests.post(url, headers=headers, json=data)
+    response = get_client().post(url, headers=headers, json=data)
     return response.status_code
 
 
+def start_template_update(update_uuid):
+    """start (or resume) sending the dispatches for a TemplateUpdate. Each
+       start is a new chain of batches, and a batch of a previous chain
+       that is still scheduled stops when it runs, so dispatches are never
+       sent twice by two chains.
+    """
+    chain = str(uuid.uuid4())
+    get_redis().set("%s:chain:%s" % (template_update_prefix, update_uuid), chain)
+    return django_rq.enqueue(run_template_update, update_uuid=update_uuid, chain=chain)
+
+
+def run_template_update(update_uuid, chain=None):
+    """send template update dispatches for the next batch of articles of a
+       TemplateUpdate (TEMPLATE_UPDATE_BATCH_SIZE articles that haven't been
+       done yet) with TEMPLATE_UPDATE_WORKERS threads. The results are saved,
+       and the next batch is scheduled to stay under TEMPLATE_UPDATE_RATE
+       dispatches a minute. Articles deferred for an owner's rate limit
+       aren't done, and the next batch waits for the reset. Only the chain
+       from the latest start_template_update runs, one batch at a time.
+    """
+    redis = get_redis()
+    chain_key = "%s:chain:%s" % (template_update_prefix, update_uuid)
+    current = redis.get(chain_key)
+    if chain is not None and (current is None or current.decode("utf-8") != chain):
+        print("Template update %s chain %s was replaced" % (update_uuid, chain))
+        return
+
+    # A batch of the chain before a restart may still be running
+    lock = redis.lock("%s:lock:%s" % (template_update_prefix, update_uuid), timeout=600)
+    if not lock.acquire(blocking=False):
+        django_rq.get_scheduler("default").enqueue_in(
+            timedelta(seconds=30),
+            run_template_update,
+            update_uuid=update_uuid,
+            chain=chain,
+        )
+        return
+
+    try:
+        wait = run_template_batch(update_uuid)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            print("Lock for template update %s expired" % update_uuid)
+
+    # Schedule the next batch, unless the chain was replaced meanwhile
+    current = redis.get(chain_key)
+    if wait is not None and (
+        chain is None or (current is not None and current.decode("utf-8") == chain)
+    ):
+        django_rq.get_scheduler("default").enqueue_in(
+            timedelta(seconds=wait),
+            run_template_update,
+            update_uuid=update_uuid,
+            chain=chain,
+        )
+
+
+def run_template_batch(update_uuid):
+    """send the dispatches for the next batch of a TemplateUpdate and save
+       the results. Returns the seconds to wait before the next batch, or
+       None if the update is finished.
+    """
+    try:
+        update = TemplateUpdate.objects.get(uuid=update_uuid)
+    except TemplateUpdate.DoesNotExist:
+        return
+
+    start = time.time()
+    batch = update.remaining[:TEMPLATE_UPDATE_BATCH_SIZE]
+    deferred = []
+    with ThreadPoolExecutor(max_workers=TEMPLATE_UPDATE_WORKERS) as pool:
+        for name, result in zip(batch, pool.map(update_template_thread, batch)):
+            if result == "deferred":
+                deferred.append(name)
+            else:
+                update.results[name] = result
+
+    update.status = "running" if update.remaining else "finished"
+    update.save(update_fields=["results", "status", "modified"])
+    print("Template update %s: %s" % (update.uuid, update.progress))
+    if not update.remaining:
+        return
+
+    # The least time a batch can take, to stay under the rate
+    seconds = 60.0 * TEMPLATE_UPDATE_BATCH_SIZE / TEMPLATE_UPDATE_RATE
+    wait = max(0, seconds - (time.time() - start))
+
+    # Deferred articles are retried once their owner's rate limit resets
+    for article in Article.objects.filter(name__in=deferred).select_related("owner"):
+        wait = max(wait, get_user_budget_wait(article.owner))
+    return wait
+
+
+def update_template_thread(name):
+    """update the template for an article in a thread of run_template_update,
+       returning an error as the result and closing the database connection.
+    """
+    try:
+        return update_template(name, defer=False)
+    except Exception as exc:
+        return "error: %s" % exc
+    finally:
+        connection.close()
+
+
 def get_repository_topics(user, repo):
     """get the topics for a repository. The intended use case is to use
        topics to update an article's tags.
@@ -269,7 +423,7 @@ def get_repository_topics(user, repo):
 
         # GET /repos/:owner/:repo/topics
         url = "%s/repos/%s/topics" % (api_base, repo["full_name"])
-        response = requests.get(url, headers=headers)
+        response = conditional_get(url, headers=headers)
         if response.status_code == 200:
             return response.json().get("names", [])
 
@@ -305,7 +459,7 @@ def fork_repository(user, template, repository=None):
                 data = {"organization": owner}
 
         url = "%s/repos/%s/%s/forks" % (api_base, repo_owner, repo_name)
-        response = requests.post(url, headers=headers, json=data)
+        response = get_client().post(url, headers=headers, json=data)
 
         # Success?
         if response.status_code in [200, 202, 201]:
@@ -317,7 +471,7 @@ def fork_repository(user, template, repository=None):
                 updates["name"] = term_name
 
             url = "%s/repos/%s/%s" % (api_base, owner, repo_name)
-            response = requests.patch(url, headers=headers, json=updates)
+            response = get_client().patch(url, headers=headers, json=updates)
             if response.status_code == 200:
                 repo = response.json()
 
@@ -342,13 +496,13 @@ def copy_repository_template(user, template, repository, description=None):
             "description": description or "Documentation repository for AskCI",
         }
         url = "%s/repos/%s/%s/generate" % (api_base, template_owner, template_repo)
-        response = requests.post(url, headers=headers, json=data)
+        response = get_client().post(url, headers=headers, json=data)
         if response.status_code in [200, 201]:
             return response.json()
 
 
 def list_repos(user, headers=None):
-    """list_repos will list the public repos for a user
+    """list_repos will yield the repos for a user, as each page arrives
 
        Parameters
        ==========
@@ -359,8 +513,7 @@ def list_repos(user, headers=None):
         headers = get_auth(user)
 
     url = "%s/user/repos" % (api_base)
-    repos = paginate(url=url, headers=headers)
-    return repos
+    return paginate(url=url, headers=headers)
 
 
 # Subscriptions
@@ -395,7 +548,7 @@ def subscribe_to(user, repo):
     if subscribed == False:
         headers = get_auth(user)
         url = "%s/repos/%s/subscription" % (api_base, repo["full_name"])
-        response = requests.put(url, headers=headers)
+        response = get_client().put(url, headers=headers)
         if response.status_code == 200:
             subscribed = True
 
@@ -414,7 +567,7 @@ def unsubscribe_from(user, repo):
     if subscribed == True:
         headers = get_auth(user)
         url = "%s/repos/%s/subscription" % (api_base, repo["full_name"])
-        response = requests.delete(url, headers=headers)
+        response = get_client().delete(url, headers=headers)
         if response.status_code == 204:
             subscribed = False
 
@@ -423,12 +576,15 @@ def unsubscribe_from(user, repo):
 
 # Webhooks
 
+# One webhook per repository is subscribed to all of the events we handle
+webhook_events = ["push", "deployment", "pull_request", "repository"]
+
 
 def create_webhook(
-    user, repo, secret, events=["push", "deployment"], reverse_url="receive_hook"
+    user, repo, secret, events=webhook_events, reverse_url="receive_hook"
 ):
     """create_webhook will create a webhook for a repo to send back
-       to askci on push.
+       to askci on push, pull request, and repository events.
 
        Parameters
        ==========
@@ -452,6 +608,58 @@ def create_webhook(
         return response
 
 
+def update_webhook(user, repo, hook_id, events=webhook_events):
+    """update the events that a webhook is subscribed to.
+       https://developer.github.com/v3/repos/hooks/#edit-a-hook
+    """
+    if user.has_github_create():
+        headers = get_auth(user)
+        url = "%s/repos/%s/hooks/%s" % (api_base, repo["full_name"], hook_id)
+        response = get_client().patch(url, headers=headers, json={"events": events})
+        return response.json()
+
+
+def consolidate_webhooks(article_uuid):
+    """articles created before we used a single webhook have three (push and
+       deployment, pull_request, and repository). GitHub doesn't allow two
+       webhooks with the same url, so the push webhook is updated to have all
+       of the events, and the other two are deleted. Articles without a
+       push webhook id (e.g., it failed to be created) are reported and
+       skipped. Run for all articles with python manage.py
+       consolidate_webhooks.
+    """
+    try:
+        article = Article.objects.get(uuid=article_uuid)
+    except Article.DoesNotExist:
+        return
+
+    if "push-deploy" not in article.webhook or article.owner is None:
+        return
+
+    # The webhook may not have been created (an error was stored instead)
+    push = article.webhook["push-deploy"] or {}
+    if "id" not in push:
+        print("Cannot consolidate webhooks for %s: %s" % (article.name, push))
+        return
+
+    # Wait for the rate limit to reset if interactive requests need it
+    if defer_for_budget(article.owner, consolidate_webhooks, article_uuid=article_uuid):
+        return
+
+    webhook = update_webhook(article.owner, article.repo, push["id"])
+    if not webhook or "id" not in webhook:
+        print("Cannot update webhook for %s: %s" % (article.name, webhook))
+        return
+
+    for name in ["pull_request", "repository"]:
+        hook = article.webhook.get(name) or {}
+        if "id" in hook:
+            delete_webhook(article.owner, article.repo, hook["id"])
+
+    article.webhook = {"askci": webhook}
+    article.save(update_fields=["webhook", "modified"])
+
+
 ## Delete
 
 
@@ -468,10 +676,10 @@ def delete_webhook(user, repo, hook_id):
     """
     if user.has_github_create():
         headers = get_auth(user)
-        url = "%s/repos/%s/hooks/%s" % (api_base, repo, hook_id)
+        url = "%s/repos/%s/hooks/%s" % (api_base, repo["full_name"], hook_id)
 
         response = DELETE(url, headers)
-        return response.json()
+        return response.status_code
 
 
 # Receive GitHub webhook
@@ -483,9 +691,12 @@ def receive_github_hook(request):
 
           push/deploy: indicates that the content for the repository changed
           pull_request: there is an update to a pull request.
+          repository: the repository was renamed, transferred, etc.
 
-         This function checks that (globally) the event is valid, and if
-         so, runs a function depending on the event.
+         This function checks that (globally) the event is valid and that
+         the payload is signed with the article secret, and if so adds it
+         to a redis stream and returns. The consume_webhooks command then
+         runs a function depending on the event (see github/events.py).
     """
     # We do these checks again for sanity
     if request.method == "POST":
@@ -515,7 +726,7 @@ def receive_github_hook(request):
             )
 
         # But don't allow types beyond push, deploy, pr
-        if event not in ["push", "deployment", "pull_request", "repository"]:
+        if event not in webhook_events:
             return JsonResponseMessage(message="Incorrect delivery method.")
 
         # A signature is also required
@@ -523,30 +734,21 @@ def receive_github_hook(request):
         if not signature:
             return JsonResponseMessage(message="Missing credentials.")
 
-        # Parse the body
+        # Parse the body, only to find the article secret
         payload = load_body(request)
-        repo = payload.get("repository")
-        repo_name = repo["full_name"]
-
-        # If it's a repository event, might be transferred or renamed
-        if event == "repository":
-            if payload.get("action") == "transferred":
-                owner = payload["changes"]["owner"]["from"]["user"]["login"]
-                repo_name = "%s/%s" % (owner, repo.get("name"))
-
-        # Retrieve the article
-        try:
-            article = Article.objects.get(repo__full_name=repo_name)
-        except Article.DoesNotExist:
+        article = get_webhook_article(
+            event, payload, Article.objects.values("secret", "archived")
+        )
+        if article is None:
             return JsonResponseMessage(message="Article not found", status=404)
 
         # Don't continue if the repository is archived (this shouldn't happen)
-        if article.archived:
+        if article["archived"]:
             return JsonResponseMessage(message="Repository is archived.")
 
         # Validate the payload with the collection secret
         status = validate_payload(
-            secret=str(article.secret),
+            secret=str(article["secret"]),
             payload=request.body,
             request_signature=signature,
         )
@@ -554,49 +756,13 @@ def receive_github_hook(request):
         if not status:
             return JsonResponseMessage(message="Invalid credentials.")
 
-        # Branch must be master
-        branch = payload.get("ref", "refs/heads/master").replace("refs/heads/", "")
-
-        # Update repo metadata that might change
-        article.repo = repo
-        article.save()
-
-        # Submit job with django_rq to update article
-        if event == "pull_request":
-
-            against_branch = payload["pull_request"]["base"]["ref"]
-            branch = payload["pull_request"]["head"]["ref"]
-
-            if not branch.startswith("update/term") or against_branch != "master":
-                return JsonResponseMessage(message="Ignoring branch.", status=200)
-
-            # Requesting user is derived from branch
-            user = branch.replace("update/term-", "").split("-")[0]
-
-            res = django_rq.enqueue(
-                update_pullrequest,
-                article_uuid=article.uuid,
-                user=user,
-                action=payload["action"],
-                url=payload["pull_request"]["html_url"],
-                number=payload["number"],
-                merged_at=payload["pull_request"]["merged_at"],
-            )
-
-        elif event in ["push", "deployment"]:
-            if branch != "master":
-                return JsonResponseMessage(message="Ignoring branch.", status=200)
-
-            article.commit = payload["after"]
-            article.save()
-            res = django_rq.enqueue(update_article, article_uuid=article.uuid)
-
-        elif event == "repository":
-            res = django_rq.enqueue(
-                repository_change,
-                article_uuid=article.uuid,
-                action=payload["action"],
-                repo=json.dumps(payload["repository"]),
+        # The article is updated and jobs submit by consume_webhooks
+        delivery = request.META["HTTP_X_GITHUB_DELIVERY"]
+        if not accept_webhook(event, delivery, request.body):
+            return JsonResponseMessage(
+                message="Delivery already received.",
+                status=200,
+                status_message="Received",
             )
 
         return JsonResponseMessage(
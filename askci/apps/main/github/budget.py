@@ -0,0 +1,124 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from askci.apps.main.utils import generate_sha256, get_redis
+from askci.settings import GITHUB_BUDGET_RESERVE
+
+from datetime import timedelta
+from redis.exceptions import RedisError
+import django_rq
+import time
+
+# Each token has a hash with the remaining requests, limit, and reset time
+budget_prefix = "askci:github:budget"
+
+
+def get_budget_key(token):
+    """tokens are never stored, the key is derived from a hash of the token
+    """
+    return "%s:%s" % (budget_prefix, generate_sha256(token))
+
+
+def get_request_token(headers):
+    """return the token from the Authorization header of a request, if any
+    """
+    auth = (headers or {}).get("Authorization", "")
+    if auth.startswith("token "):
+        return auth.replace("token ", "", 1)
+
+
+def record_budget(request_headers, response_headers):
+    """update the budget for the token used by a request from the rate limit
+       headers that GitHub returns with every API response (including 304s).
+       Only the core resource is tracked (search has a separate limit).
+    """
+    token = get_request_token(request_headers)
+    if not token or "X-RateLimit-Remaining" not in response_headers:
+        return
+
+    if response_headers.get("X-RateLimit-Resource", "core") != "core":
+        return
+
+    reset = int(response_headers.get("X-RateLimit-Reset", time.time() + 3600))
+    key = get_budget_key(token)
+    try:
+        pipeline = get_redis().pipeline()
+        pipeline.hset(key, "remaining", response_headers["X-RateLimit-Remaining"])
+        pipeline.hset(key, "limit", response_headers.get("X-RateLimit-Limit", 5000))
+        pipeline.hset(key, "reset", reset)
+        pipeline.hset(key, "updated", int(time.time()))
+        pipeline.expireat(key, reset + 60)
+        pipeline.execute()
+    except RedisError:
+        pass
+
+
+def parse_budget(values):
+    """parse a budget hash from redis. After the reset time the bucket is
+       full again.
+    """
+    budget = {k.decode("utf-8"): int(float(v)) for k, v in values.items()}
+    if budget["reset"] <= time.time():
+        budget["remaining"] = budget["limit"]
+    return budget
+
+
+def get_budget(token):
+    """return the budget for a token (remaining, limit, and reset), or None
+       if we haven't seen a response for it.
+    """
+    values = get_redis().hgetall(get_budget_key(token))
+    if values:
+        return parse_budget(values)
+
+
+def get_budget_wait(token, reserve=GITHUB_BUDGET_RESERVE):
+    """return the seconds that a background job using the token should wait,
+       which is 0 unless the remaining requests have dropped below the
+       reserve kept for interactive requests.
+    """
+    if not token:
+        return 0
+    try:
+        budget = get_budget(token)
+    except RedisError:
+        return 0
+    if budget is None or budget["remaining"] > reserve:
+        return 0
+    return max(int(budget["reset"] - time.time()), 0) + 1
+
+
+def defer_if_exhausted(token, func, **kwargs):
+    """background jobs call this before using the API. If the budget for
+       the token is below the reserve, the job (func with kwargs) is
+       scheduled again for after the reset and True is returned, so the
+       caller can stop. Interactive requests don't check the budget, which
+       keeps the reserve for them.
+    """
+    wait = get_budget_wait(token)
+    if wait == 0:
+        return False
+
+    print("GitHub budget is below reserve, deferring %s %ss" % (func.__name__, wait))
+    scheduler = django_rq.get_scheduler("default")
+    scheduler.enqueue_in(timedelta(seconds=wait), func, **kwargs)
+    return True
+
+
+def list_budgets():
+    """return a dictionary of budget keys and budgets, for the dashboard
+    """
+    redis = get_redis()
+    budgets = {}
+    for key in redis.scan_iter(match="%s:*" % budget_prefix):
+        values = redis.hgetall(key)
+        if values:
+            budgets[key.decode("utf-8")] = parse_budget(values)
+    return budgets
@@ -0,0 +1,221 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from askci.apps.main.github.budget import record_budget
+from askci.apps.main.utils import get_redis
+from askci.settings import (
+    GITHUB_POOL_SIZE,
+    GITHUB_RAW_BASE,
+    GITHUB_REQUEST_BACKOFF,
+    GITHUB_REQUEST_INTERACTIVE_WAIT,
+    GITHUB_REQUEST_MAX_WAIT,
+    GITHUB_REQUEST_RETRIES,
+    GITHUB_REQUEST_TIMEOUT,
+)
+
+from redis.exceptions import RedisError
+from urllib.parse import urlparse
+import logging
+import re
+import requests
+import time
+
+logger = logging.getLogger(__name__)
+
+# Latency for each endpoint is kept in this redis hash, see get_latency_stats
+latency_key = "askci:github:latency"
+
+# Methods that are safe to retry after a server error or dropped connection
+idempotent_methods = ["GET", "HEAD", "PUT", "DELETE"]
+
+# One client per process, see get_client
+github_client = None
+
+# Set for web processes (see askci/wsgi.py), which don't wait long to retry
+interactive = False
+
+
+def set_interactive(value=True):
+    """mark the process as serving web requests, so a retry that would wait
+       longer than GITHUB_REQUEST_INTERACTIVE_WAIT seconds (e.g., for a
+       secondary rate limit) isn't made, and the response is returned for
+       the view to report. Workers wait up to GITHUB_REQUEST_MAX_WAIT.
+    """
+    global interactive
+    interactive = value
+
+
+class GitHubClient:
+    """A client for the GitHub API (and raw content) shared by the process.
+       The session keeps connections alive in a pool, every request has
+       a timeout, server errors are retried with exponential backoff
+       (for idempotent requests) as are secondary rate limits, and the
+       latency of each endpoint is recorded. Rate limit headers update
+       the budget for the token used, see askci.apps.main.github.budget.
+    """
+
+    def __init__(
+        self,
+        timeout=GITHUB_REQUEST_TIMEOUT,
+        retries=GITHUB_REQUEST_RETRIES,
+        backoff=GITHUB_REQUEST_BACKOFF,
+        max_wait=GITHUB_REQUEST_MAX_WAIT,
+        pool_size=GITHUB_POOL_SIZE,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_wait = max_wait
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def __str__(self):
+        return "<GitHubClient:%s>" % self.timeout
+
+    def __repr__(self):
+        return self.__str__()
+
+    def get(self, url, headers=None, **kwargs):
+        return self.request("GET", url, headers=headers, **kwargs)
+
+    def post(self, url, headers=None, **kwargs):
+        return self.request("POST", url, headers=headers, **kwargs)
+
+    def put(self, url, headers=None, **kwargs):
+        return self.request("PUT", url, headers=headers, **kwargs)
+
+    def patch(self, url, headers=None, **kwargs):
+        return self.request("PATCH", url, headers=headers, **kwargs)
+
+    def delete(self, url, headers=None, **kwargs):
+        return self.request("DELETE", url, headers=headers, **kwargs)
+
+    def request(self, method, url, headers=None, **kwargs):
+        """send a request, retrying as needed. Extra keyword arguments
+           (json, data, stream) are passed on to the session.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                self.record(method, url, time.time() - start, "error")
+                wait = self.backoff * 2 ** attempt
+                if (
+                    method not in idempotent_methods
+                    or attempt >= self.retries
+                    or (interactive and wait > GITHUB_REQUEST_INTERACTIVE_WAIT)
+                ):
+                    raise
+                logger.warning("Retrying %s %s in %ss: %s" % (method, url, wait, exc))
+            else:
+                self.record(method, url, time.time() - start, response.status_code)
+                record_budget(headers, response.headers)
+                wait = self.get_retry_wait(method, response, attempt)
+                if wait is None:
+                    return response
+                logger.warning(
+                    "Retrying %s %s in %ss: status %s"
+                    % (method, url, wait, response.status_code)
+                )
+                response.close()
+
+            time.sleep(wait)
+            attempt += 1
+
+    def get_retry_wait(self, method, response, attempt):
+        """return the seconds to wait before retrying a response, or None
+           if it shouldn't be retried. Secondary rate limits (403 or 429
+           with Retry-After, or the secondary rate limit message) were not
+           processed by GitHub so any method can be retried. Server errors
+           are only retried for idempotent methods.
+        """
+        if attempt >= self.retries:
+            return
+
+        wait = self.backoff * 2 ** attempt
+        if response.status_code in [403, 429]:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after is not None and retry_after.isdigit():
+                wait = max(wait, int(retry_after))
+            elif not re.search("secondary rate limit|abuse", response.text, re.I):
+                return
+
+        elif response.status_code < 500 or method not in idempotent_methods:
+            return
+
+        max_wait = self.max_wait
+        if interactive:
+            max_wait = min(max_wait, GITHUB_REQUEST_INTERACTIVE_WAIT)
+        if wait > max_wait:
+            return
+        return wait
+
+    def record(self, method, url, seconds, status):
+        """record the latency of a request for its endpoint in redis, so that
+           latency is visible across web and worker processes.
+        """
+        endpoint = get_endpoint(method, url)
+        logger.debug("%s %s %.3fs" % (endpoint, status, seconds))
+        try:
+            pipeline = get_redis().pipeline()
+            pipeline.hincrby(latency_key, "%s|count" % endpoint, 1)
+            pipeline.hincrbyfloat(latency_key, "%s|seconds" % endpoint, seconds)
+            if status == "error" or status >= 500:
+                pipeline.hincrby(latency_key, "%s|errors" % endpoint, 1)
+            pipeline.execute()
+        except RedisError:
+            pass
+
+
+def get_endpoint(method, url):
+    """reduce a url to an endpoint name, so that requests for different
+       repositories or users are counted together, e.g.,
+       GET api.github.com/repos/:owner/:repo/topics
+    """
+    parsed = urlparse(url)
+    path = parsed.path
+    if url.startswith(GITHUB_RAW_BASE):
+        path = "%s/:owner/:repo/:ref/:path" % urlparse(GITHUB_RAW_BASE).path.rstrip("/")
+    else:
+        path = re.sub("^/repos/[^/]+/[^/]+", "/repos/:owner/:repo", path)
+        path = re.sub("^/users/[^/]+", "/users/:user", path)
+        path = re.sub("/[0-9]+(?=/|$)", "/:id", path)
+    return "%s %s%s" % (method, parsed.netloc, path)
+
+
+def get_client():
+    """return the GitHub client for the process, creating it if needed
+    """
+    global github_client
+    if github_client is None:
+        github_client = GitHubClient()
+    return github_client
+
+
+def get_latency_stats():
+    """return a dictionary of endpoints, each with a count of requests,
+       errors, and the average latency in seconds.
+    """
+    stats = {}
+    for field, value in get_redis().hgetall(latency_key).items():
+        endpoint, name = field.decode("utf-8").rsplit("|", 1)
+        stats.setdefault(endpoint, {"count": 0, "errors": 0, "seconds": 0.0})
+        stats[endpoint][name] = float(value) if name == "seconds" else int(value)
+
+    for endpoint, values in stats.items():
+        values["average"] = values["seconds"] / max(values["count"], 1)
+    return stats
@@ -0,0 +1,329 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.db import close_old_connections
+from askci.apps.main.models import Article
+from askci.apps.main.tasks import (
+    repository_change,
+    schedule_article_update,
+    update_pullrequest,
+)
+from askci.apps.main.utils import get_redis
+from askci.settings import (
+    WEBHOOK_CLAIM_IDLE,
+    WEBHOOK_DELIVERY_TTL,
+    WEBHOOK_LOG_MAXLEN,
+    WEBHOOK_MAX_DELIVERIES,
+    WEBHOOK_RETRY_DELAY,
+    WEBHOOK_STREAM_MAXLEN,
+)
+
+from redis.exceptions import RedisError, ResponseError
+import django_rq
+import json
+import time
+import zlib
+
+# Accepted webhook deliveries are appended here by receive_github_hook
+webhook_stream = "askci:webhooks"
+webhook_group = "askci-webhooks"
+
+# Delivery ids seen (to drop redeliveries), and a compressed log to replay
+delivery_prefix = "askci:webhooks:delivery"
+webhook_log = "askci:webhooks:log"
+
+
+def get_webhook_repo_name(event, payload):
+    """return the full name of the repository that an article is stored
+       with. If a repository was transferred, this is the previous owner
+       (a user or an organization).
+    """
+    repo = payload.get("repository") or {}
+    repo_name = repo.get("full_name")
+    if event == "repository" and payload.get("action") == "transferred":
+        changes = (payload.get("changes") or {}).get("owner") or {}
+        previous = changes.get("from") or {}
+        owner = previous.get("user") or previous.get("organization") or {}
+        if owner.get("login"):
+            repo_name = "%s/%s" % (owner["login"], repo.get("name"))
+    return repo_name
+
+
+def get_webhook_article(event, payload, queryset=None):
+    """return the article that a webhook payload is for (from queryset, e.g.,
+       with only some values), or None. The repository id doesn't change
+       when a repository is renamed or transferred (the payload has the new
+       full name), so it's looked up first, and the full name only if
+       there is no article for the id (e.g., it wasn't indexed yet).
+    """
+    if queryset is None:
+        queryset = Article.objects.all()
+
+    repo_id = (payload.get("repository") or {}).get("id")
+    if repo_id is not None:
+        article = queryset.filter(repo_id=repo_id).first()
+        if article is not None:
+            return article
+    return queryset.filter(repo_full_name=get_webhook_repo_name(event, payload)).first()
+
+
+def accept_webhook(event, delivery, body):
+    """accept a verified webhook delivery, unless we have already seen the
+       delivery id (GitHub redelivers when we are slow to respond). The
+       delivery is added to the stream for consume_webhooks and to the
+       replay log. Returns False for a duplicate.
+    """
+    redis = get_redis()
+    key = "%s:%s" % (delivery_prefix, delivery)
+    if not redis.set(key, int(time.time()), nx=True, ex=WEBHOOK_DELIVERY_TTL):
+        return False
+
+    fields = {
+        "event": event,
+        "delivery": delivery,
+        "body": body,
+        "received": time.time(),
+    }
+    try:
+        pipeline = redis.pipeline()
+        pipeline.xadd(
+            webhook_stream, fields, maxlen=WEBHOOK_STREAM_MAXLEN, approximate=True
+        )
+        fields["body"] = zlib.compress(body)
+        pipeline.xadd(webhook_log, fields, maxlen=WEBHOOK_LOG_MAXLEN, approximate=True)
+        pipeline.execute()
+
+    # If the delivery wasn't added, GitHub can deliver it again
+    except RedisError:
+        redis.delete(key)
+        raise
+    return True
+
+
+def replay_webhooks(start, end, events=None, dry_run=False):
+    """add deliveries from the replay log received between start and end
+       (datetimes) to the stream again, e.g., after an outage of the
+       consumer. Deliveries can be limited to a list of events. Returns the
+       number of deliveries replayed.
+    """
+    redis = get_redis()
+    minimum = "%d" % (start.timestamp() * 1000)
+    maximum = "%d" % (end.timestamp() * 1000)
+
+    count = 0
+    while True:
+        entries = redis.xrange(webhook_log, min=minimum, max=maximum, count=500)
+        for entry_id, fields in entries:
+            event = fields[b"event"].decode("utf-8")
+            if events and event not in events:
+                continue
+            delivery = fields[b"delivery"].decode("utf-8")
+            print("Replaying %s %s" % (event, delivery))
+            if not dry_run:
+                enqueue_webhook(event, delivery, zlib.decompress(fields[b"body"]))
+            count += 1
+
+        if len(entries) < 500:
+            return count
+
+        # Continue after the last entry
+        milliseconds, sequence = entries[-1][0].decode("utf-8").split("-")
+        minimum = "%s-%s" % (milliseconds, int(sequence) + 1)
+
+
+def enqueue_webhook(event, delivery, body):
+    """append a verified webhook delivery (the raw body) to the stream, to be
+       processed by consume_webhooks. The stream is capped (approximately)
+       at WEBHOOK_STREAM_MAXLEN entries.
+    """
+    fields = {
+        "event": event,
+        "delivery": delivery,
+        "body": body,
+        "received": time.time(),
+    }
+    return get_redis().xadd(
+        webhook_stream, fields, maxlen=WEBHOOK_STREAM_MAXLEN, approximate=True
+    )
+
+
+def process_webhook(event, payload):
+    """resolve the article for a webhook payload, update the repository
+       metadata, and submit jobs for the event. Returns a message.
+    """
+    repo = payload.get("repository")
+    repo_name = (repo or {}).get("full_name")
+
+    article = get_webhook_article(event, payload)
+    if article is None:
+        return "Article %s not found" % repo_name
+
+    # Don't continue if the repository is archived (this shouldn't happen)
+    if article.archived:
+        return "Repository %s is archived." % repo_name
+
+    # Branch must be master
+    branch = payload.get("ref", "refs/heads/master").replace("refs/heads/", "")
+
+    # Update repo metadata that might change
+    article.repo = repo
+    update_fields = ["repo", "modified"]
+
+    if event == "pull_request":
+        article.save(update_fields=update_fields)
+
+        against_branch = payload["pull_request"]["base"]["ref"]
+        branch = payload["pull_request"]["head"]["ref"]
+
+        if not branch.startswith("update/term") or against_branch != "master":
+            return "Ignoring branch %s." % branch
+
+        # Requesting user is derived from branch
+        user = branch.replace("update/term-", "").split("-")[0]
+
+        django_rq.enqueue(
+            update_pullrequest,
+            article_uuid=article.uuid,
+            user=user,
+            action=payload["action"],
+            url=payload["pull_request"]["html_url"],
+            number=payload["number"],
+            merged_at=payload["pull_request"]["merged_at"],
+        )
+
+    elif event in ["push", "deployment"]:
+        if branch != "master":
+            article.save(update_fields=update_fields)
+            return "Ignoring branch %s." % branch
+
+        article.commit = payload["after"]
+        article.save(update_fields=update_fields + ["commit"])
+        schedule_article_update(article.uuid)
+
+    elif event == "repository":
+        article.save(update_fields=update_fields)
+        django_rq.enqueue(
+            repository_change,
+            article_uuid=article.uuid,
+            action=payload["action"],
+            repo=json.dumps(payload["repository"]),
+        )
+
+    return "Processed %s for %s" % (event, repo_name)
+
+
+def process_entry(fields):
+    """process a stream entry (a dictionary of bytes)
+    """
+    event = fields[b"event"].decode("utf-8")
+    payload = json.loads(fields[b"body"].decode("utf-8"))
+    return process_webhook(event, payload)
+
+
+def claim_webhooks(redis, consumer):
+    """claim deliveries that another consumer read but didn't acknowledge
+       (e.g., it died or was renamed) once they have been idle for
+       WEBHOOK_CLAIM_IDLE seconds. Returns the number claimed.
+    """
+    idle = WEBHOOK_CLAIM_IDLE * 1000
+    pending = redis.xpending_range(webhook_stream, webhook_group, "-", "+", 100)
+    entry_ids = [
+        entry["message_id"]
+        for entry in pending
+        if entry["time_since_delivered"] >= idle
+        and entry["consumer"].decode("utf-8") != consumer
+    ]
+    if entry_ids:
+        redis.xclaim(webhook_stream, webhook_group, consumer, idle, entry_ids)
+        print("Claimed %s pending webhooks" % len(entry_ids))
+    return len(entry_ids)
+
+
+def get_deliveries(redis, entry_id):
+    """return the number of times an entry was delivered to a consumer
+    """
+    pending = redis.xpending_range(webhook_stream, webhook_group, entry_id, entry_id, 1)
+    return pending[0]["times_delivered"] if pending else 0
+
+
+def consume_webhooks(consumer="consumer-1", count=50, block=5000):
+    """read webhook deliveries from the stream as part of a consumer group,
+       forever. Entries that this consumer read but didn't acknowledge
+       (e.g., it was restarted, or processing failed) are processed first,
+       and entries left pending by other consumers are claimed. An entry
+       is acknowledged when it's processed or can never be (e.g., it isn't
+       valid json). Other errors (e.g., the database is unavailable) leave
+       it pending to retry, up to WEBHOOK_MAX_DELIVERIES times.
+    """
+    redis = get_redis()
+    try:
+        redis.xgroup_create(webhook_stream, webhook_group, id="0", mkstream=True)
+    except ResponseError as exc:
+        if "BUSYGROUP" not in str(exc):
+            raise
+
+    last_id = "0"
+    claimed = 0
+    while True:
+
+        # A connection that was dropped (e.g., the database restarted) is replaced
+        close_old_connections()
+
+        if time.time() - claimed > WEBHOOK_CLAIM_IDLE / 2:
+            if claim_webhooks(redis, consumer):
+                last_id = "0"
+            claimed = time.time()
+
+        streams = redis.xreadgroup(
+            webhook_group,
+            consumer,
+            {webhook_stream: last_id},
+            count=count,
+            block=block,
+        )
+        entries = streams[0][1] if streams else []
+
+        # Once our pending entries are done, read new entries
+        if last_id == "0" and not entries:
+            last_id = ">"
+            continue
+
+        failed = False
+        for entry_id, fields in entries:
+
+            # A pending entry can be trimmed from the stream before it's read
+            if not fields:
+                redis.xack(webhook_stream, webhook_group, entry_id)
+                continue
+
+            try:
+                print(process_entry(fields))
+
+            # The delivery can't be processed, retrying won't help
+            except (KeyError, TypeError, ValueError) as exc:
+                print("Dropping webhook %s: %s" % (entry_id, exc))
+
+            except Exception as exc:
+                if get_deliveries(redis, entry_id) < WEBHOOK_MAX_DELIVERIES:
+                    print(
+                        "Error processing webhook %s, will retry: %s" % (entry_id, exc)
+                    )
+                    failed = True
+                    continue
+                print(
+                    "Giving up on webhook %s (it can be replayed): %s" % (entry_id, exc)
+                )
+
+            redis.xack(webhook_stream, webhook_group, entry_id)
+
+        # Retry failed entries (pending for this consumer) after a delay
+        if failed:
+            time.sleep(WEBHOOK_RETRY_DELAY)
+            last_id = "0"
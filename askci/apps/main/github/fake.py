@@ -0,0 +1,466 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+import time
+import urllib.request
+import uuid
+
+# A small, in memory stand in for the parts of the GitHub API (and raw
+# content) that AskCI uses, to run and benchmark it offline. Start it with
+# python manage.py fake_github, and set GITHUB_API_BASE and GITHUB_RAW_BASE
+# to the urls it prints. This module only uses the standard library.
+
+readme_template = """# %(term)s
+
+<span id="question-what-is-%(term)s">What is %(term)s?</span>
+
+%(term)s is a term generated by the fake GitHub server, at commit %(commit)s.
+
+<span id="example-%(term)s-usage">How do I use %(term)s?</span>
+
+```bash
+%(term)s --help
+```
+"""
+
+
+def new_commit():
+    return uuid.uuid4().hex + uuid.uuid4().hex[:8]
+
+
+class FakeGitHub:
+    """The state of the fake GitHub: repositories (with files, hooks, topics
+       and subscriptions) and the rate limit for each token. Responses can be
+       slowed down (latency plus random jitter, in seconds) and a fraction
+       (error_rate) can fail with a 502.
+    """
+
+    def __init__(
+        self,
+        owner="askci",
+        repos=10,
+        latency=0,
+        jitter=0,
+        error_rate=0,
+        rate_limit=5000,
+        template="hpsee/askci-template-term",
+    ):
+        self.owner = owner
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.repos = {}
+        self.budgets = {}
+        self.counts = {}
+        self.next_id = 1000
+
+        self.add_repo(template, files={"README.md": readme_template})
+        for number in range(repos):
+            self.add_repo("%s/askci-term-term%s" % (owner, number))
+
+    def __str__(self):
+        return "<FakeGitHub:%s>" % len(self.repos)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def get_id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def add_repo(self, full_name, description=None, files=None):
+        """add a repository, with a generated README.md for the term unless
+           files are provided.
+        """
+        owner, name = full_name.split("/")
+        repo = {
+            "id": self.get_id(),
+            "name": name,
+            "full_name": full_name,
+            "owner": {"login": owner},
+            "description": description or "Documentation repository for AskCI",
+            "html_url": "https://github.com/%s" % full_name,
+            "private": False,
+            "archived": False,
+            "permissions": {"admin": True, "push": True, "pull": True},
+            "topics": [],
+        }
+        self.repos[full_name] = {
+            "repo": repo,
+            "commit": new_commit(),
+            "files": files,
+            "hooks": {},
+            "subscribed": False,
+        }
+        return repo
+
+    def get_file(self, full_name, path):
+        """return the content of a file, or None if it doesn't exist
+        """
+        state = self.repos.get(full_name)
+        if state is None:
+            return
+        if state["files"] is not None:
+            return state["files"].get(path)
+        if path == "README.md":
+            term = state["repo"]["name"].replace("askci-term-", "")
+            return readme_template % {"term": term, "commit": state["commit"]}
+
+    def push(self, full_name):
+        """simulate a push to a repository: change the commit (and so the
+           generated README) and deliver a push webhook to each hook.
+        """
+        state = self.repos[full_name]
+        before, state["commit"] = state["commit"], new_commit()
+        payload = {
+            "ref": "refs/heads/master",
+            "before": before,
+            "after": state["commit"],
+            "repository": state["repo"],
+        }
+        for hook in list(state["hooks"].values()):
+            if "push" in hook["events"]:
+                self.deliver(hook, "push", payload)
+        return payload
+
+    def deliver(self, hook, event, payload):
+        """send a signed webhook delivery to a hook, as GitHub does
+        """
+        body = json.dumps(payload).encode("utf-8")
+        secret = hook["config"].get("secret", "").encode("utf-8")
+        digest = hmac.new(secret, digestmod=hashlib.sha1, msg=body).hexdigest()
+        request = urllib.request.Request(
+            hook["config"]["url"],
+            data=body,
+            headers={
+                "Content-Type": "application/json",
+                "User-Agent": "GitHub-Hookshot/fake",
+                "X-GitHub-Event": event,
+                "X-GitHub-Delivery": str(uuid.uuid4()),
+                "X-Hub-Signature": "sha1=%s" % digest,
+            },
+        )
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+        except Exception as exc:
+            print("Cannot deliver %s to %s: %s" % (event, hook["config"]["url"], exc))
+
+    def spend(self, token):
+        """count a request against the rate limit for a token, returning the
+           rate limit headers.
+        """
+        with self.lock:
+            budget = self.budgets.get(token)
+            if budget is None or budget["reset"] <= time.time():
+                budget = {
+                    "remaining": self.rate_limit,
+                    "reset": int(time.time()) + 3600,
+                }
+                self.budgets[token] = budget
+            budget["remaining"] = max(budget["remaining"] - 1, 0)
+        return {
+            "X-RateLimit-Limit": str(self.rate_limit),
+            "X-RateLimit-Remaining": str(budget["remaining"]),
+            "X-RateLimit-Reset": str(budget["reset"]),
+            "X-RateLimit-Resource": "core",
+        }
+
+    def count(self, route):
+        with self.lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    """Handle requests to the fake GitHub. Routes are matched in order, and
+       each is a method, a path pattern, and the name of a handler method
+       that returns a status code and a body (json, text, or None). A
+       handler can add headers to response_headers.
+    """
+
+    github = None
+    routes = [
+        ("GET", "^/meta$", "get_meta"),
+        ("GET", "^/user/repos$", "list_repos"),
+        ("GET", "^/user/memberships/orgs$", "list_memberships"),
+        ("GET", "^/users/(?P<user>[^/]+)/orgs$", "list_orgs"),
+        ("GET", "^/repos/(?P<repo>[^/]+/[^/]+)$", "get_repo"),
+        ("GET", "^/repos/(?P<repo>[^/]+/[^/]+)/topics$", "get_topics"),
+        ("POST", "^/repos/(?P<repo>[^/]+/[^/]+)/generate$", "generate_repo"),
+        ("POST", "^/repos/(?P<repo>[^/]+/[^/]+)/forks$", "fork_repo"),
+        ("PATCH", "^/repos/(?P<repo>[^/]+/[^/]+)$", "edit_repo"),
+        ("POST", "^/repos/(?P<repo>[^/]+/[^/]+)/hooks$", "create_hook"),
+        ("PATCH", "^/repos/(?P<repo>[^/]+/[^/]+)/hooks/(?P<id>[0-9]+)$", "edit_hook"),
+        (
+            "DELETE",
+            "^/repos/(?P<repo>[^/]+/[^/]+)/hooks/(?P<id>[0-9]+)$",
+            "delete_hook",
+        ),
+        ("POST", "^/repos/(?P<repo>[^/]+/[^/]+)/dispatches$", "dispatch"),
+        ("POST", "^/repos/(?P<repo>[^/]+/[^/]+)/issues$", "create_issue"),
+        ("GET", "^/repos/(?P<repo>[^/]+/[^/]+)/subscription$", "get_subscription"),
+        ("PUT", "^/repos/(?P<repo>[^/]+/[^/]+)/subscription$", "subscribe"),
+        ("DELETE", "^/repos/(?P<repo>[^/]+/[^/]+)/subscription$", "unsubscribe"),
+        ("GET", "^/raw/(?P<repo>[^/]+/[^/]+)/(?P<ref>[^/]+)/(?P<path>.+)$", "get_raw"),
+        ("POST", "^/_fake/push/(?P<repo>[^/]+/[^/]+)$", "push"),
+        ("GET", "^/_fake/stats$", "get_stats"),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def do_PUT(self):
+        self.handle_method("PUT")
+
+    def do_PATCH(self):
+        self.handle_method("PATCH")
+
+    def do_DELETE(self):
+        self.handle_method("DELETE")
+
+    def handle_method(self, method):
+        github = self.github
+        parsed = urlparse(self.path)
+        self.params = dict(parse_qsl(parsed.query))
+        self.response_headers = {}
+
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self.data = json.loads(body.decode("utf-8")) if body else {}
+
+        if github.latency or github.jitter:
+            time.sleep(github.latency + random.uniform(0, github.jitter))
+
+        for route_method, pattern, name in self.routes:
+            match = re.search(pattern, parsed.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.send(404, {"message": "Not Found"})
+
+        github.count("%s %s" % (method, name))
+        if random.random() < github.error_rate:
+            return self.send(502, {"message": "Server Error"})
+
+        # Raw content and fake controls don't count against the rate limit
+        headers = {}
+        if name not in ["get_raw", "push", "get_stats"]:
+            headers = github.spend(
+                self.headers.get("Authorization", self.client_address[0])
+            )
+
+        try:
+            status, content = getattr(self, name)(**match.groupdict())
+        except KeyError:
+            status, content = 404, {"message": "Not Found"}
+        headers.update(self.response_headers)
+        self.send(status, content, headers)
+
+    def send(self, status, content, headers=None):
+        """send a response, with an ETag for a successful GET. If the client
+           sent the same ETag (If-None-Match) the response is a 304.
+        """
+        headers = dict(headers or {})
+        if content is None:
+            body = b""
+        elif isinstance(content, str):
+            body = content.encode("utf-8")
+            headers["Content-Type"] = "text/plain; charset=utf-8"
+        else:
+            body = json.dumps(content).encode("utf-8")
+            headers["Content-Type"] = "application/json; charset=utf-8"
+
+        if status == 200 and self.command == "GET":
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            headers["ETag"] = etag
+            if self.headers.get("If-None-Match") == etag:
+                status, body = 304, b""
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_base(self):
+        return "http://%s" % self.headers.get("Host", "localhost")
+
+    # API
+
+    def get_meta(self):
+        return (
+            200,
+            {"hooks": ["127.0.0.1/32"], "verifiable_password_authentication": True},
+        )
+
+    def list_repos(self):
+        """list all repositories, paginated with a Link header as GitHub does
+        """
+        repos = [state["repo"] for state in self.github.repos.values()]
+        per_page = int(self.params.get("per_page", 30))
+        page = int(self.params.get("page", 1))
+        last = max((len(repos) + per_page - 1) // per_page, 1)
+
+        links = []
+        url = "%s/user/repos?per_page=%s&page=%s" % (self.get_base(), per_page, "%s")
+        if page < last:
+            links.append('<%s>; rel="next"' % (url % (page + 1)))
+            links.append('<%s>; rel="last"' % (url % last))
+        if links:
+            self.response_headers["Link"] = ", ".join(links)
+        return 200, repos[(page - 1) * per_page : page * per_page]
+
+    def list_memberships(self):
+        return 200, [{"role": "admin", "organization": {"login": self.github.owner}}]
+
+    def list_orgs(self, user):
+        return 200, [{"login": self.github.owner}]
+
+    def get_repo(self, repo):
+        return 200, self.github.repos[repo]["repo"]
+
+    def edit_repo(self, repo):
+        state = self.github.repos[repo]
+        state["repo"].update(
+            {k: v for k, v in self.data.items() if k in ["description", "archived"]}
+        )
+        return 200, state["repo"]
+
+    def get_topics(self, repo):
+        return 200, {"names": self.github.repos[repo]["repo"]["topics"]}
+
+    def generate_repo(self, repo):
+        """generate a repository from a template (the template must exist)
+        """
+        self.github.repos[repo]
+        full_name = "%s/%s" % (self.data["owner"], self.data["name"])
+        if full_name in self.github.repos:
+            return 422, {"message": "Repository creation failed."}
+        return 201, self.github.add_repo(full_name, self.data.get("description"))
+
+    def fork_repo(self, repo):
+        name = repo.split("/")[1]
+        full_name = "%s/%s" % (self.data.get("organization", self.github.owner), name)
+        if full_name not in self.github.repos:
+            self.github.add_repo(
+                full_name, self.github.repos[repo]["repo"]["description"]
+            )
+        return 202, self.github.repos[full_name]["repo"]
+
+    def create_hook(self, repo):
+        hooks = self.github.repos[repo]["hooks"]
+        url = self.data.get("config", {}).get("url")
+        if any(hook["config"].get("url") == url for hook in hooks.values()):
+            return (
+                422,
+                {
+                    "message": "Validation Failed",
+                    "errors": [{"message": "Hook already exists on this repository"}],
+                },
+            )
+
+        hook_id = self.github.get_id()
+        hooks[hook_id] = {
+            "id": hook_id,
+            "name": "web",
+            "active": self.data.get("active", True),
+            "events": self.data.get("events", ["push"]),
+            "config": self.data.get("config", {}),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        }
+        return 201, self.public_hook(hooks[hook_id])
+
+    def edit_hook(self, repo, id):
+        hook = self.github.repos[repo]["hooks"][int(id)]
+        if "events" in self.data:
+            hook["events"] = self.data["events"]
+        return 200, self.public_hook(hook)
+
+    def delete_hook(self, repo, id):
+        del self.github.repos[repo]["hooks"][int(id)]
+        return 204, None
+
+    def public_hook(self, hook):
+        """the secret is never returned, as with GitHub
+        """
+        config = {k: v for k, v in hook["config"].items() if k != "secret"}
+        return dict(hook, config=config)
+
+    def dispatch(self, repo):
+        self.github.repos[repo]
+        return 204, None
+
+    def create_issue(self, repo):
+        self.github.repos[repo]
+        number = self.github.get_id()
+        url = "https://github.com/%s/issues/%s" % (repo, number)
+        return 201, {"number": number, "html_url": url, "title": self.data.get("title")}
+
+    def get_subscription(self, repo):
+        if not self.github.repos[repo]["subscribed"]:
+            return 404, {"message": "Not Found"}
+        return 200, {"subscribed": True, "ignored": False}
+
+    def subscribe(self, repo):
+        self.github.repos[repo]["subscribed"] = True
+        return 200, {"subscribed": True, "ignored": False}
+
+    def unsubscribe(self, repo):
+        self.github.repos[repo]["subscribed"] = False
+        return 204, None
+
+    # Raw content
+
+    def get_raw(self, repo, ref, path):
+        content = self.github.get_file(repo, path)
+        if content is None:
+            return 404, "404: Not Found"
+        return 200, content
+
+    # Controls for the fake
+
+    def push(self, repo):
+        return 200, self.github.push(repo)
+
+    def get_stats(self):
+        return 200, {"repos": len(self.github.repos), "requests": self.github.counts}
+
+
+def serve(host="127.0.0.1", port=9000, **kwargs):
+    """start the fake GitHub server (this blocks). Keyword arguments are
+       passed to FakeGitHub.
+    """
+    github = FakeGitHub(**kwargs)
+    handler = type("Handler", (FakeGitHubHandler,), {"github": github})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(
+        "Fake GitHub with %s repositories at http://%s:%s"
+        % (len(github.repos), host, port)
+    )
+    print("GITHUB_API_BASE=http://%s:%s" % (host, port))
+    print("GITHUB_RAW_BASE=http://%s:%s/raw" % (host, port))
+    server.serve_forever()
@@ -9,12 +9,33 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """
 
 from django.http import JsonResponse
+from askci.apps.main.utils import generate_sha256, get_redis
+from askci.apps.main.github.client import get_client
+from askci.settings import (
+    GITHUB_CACHE_TTL,
+    GITHUB_PAGE_WORKERS,
+    GITHUB_RAW_BASE,
+    GITHUB_RAW_MAX_SIZE,
+    GITHUB_RAW_WORKERS,
+)
+
+from concurrent.futures import ThreadPoolExecutor
+from redis.exceptions import RedisError
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 import hashlib
 import hmac
 import json
 import requests
 import shutil
 import os
+import zlib
+
+raw_base = GITHUB_RAW_BASE.rstrip("/")
+
+# Conditional request cache keys, see conditional_get
+cache_prefix = "askci:github:cache"
+cache_headers = ["Content-Type", "Link", "ETag", "Last-Modified"]
 
 
 ################################################################################
@@ -22,75 +43,279 @@ import os
 ################################################################################
 
 
+def get_raw_file(url):
+    """get the content of a raw file, returning None if the request fails,
+       times out, or the file is larger than GITHUB_RAW_MAX_SIZE.
+    """
+    try:
+        response = conditional_get(url, max_size=GITHUB_RAW_MAX_SIZE)
+    except ValueError as exc:
+        print("Error retrieving %s: %s" % (url, exc))
+        return
+    except requests.RequestException as exc:
+        print("Error retrieving %s: %s" % (url, exc))
+        return
+
+    if response.status_code != 200:
+        print("Error retrieving %s: status %s" % (url, response.status_code))
+        return
+    return response.content.decode("utf-8", errors="replace")
+
+
+def get_raw_files(full_name, filenames, ref="master"):
+    """get the content of one or more files in a repository (<owner>/<repo>)
+       at a ref, in parallel. Returns a dictionary of filenames and content,
+       in the same order, with None for any file that could not be fetched.
+    """
+    urls = ["%s/%s/%s/%s" % (raw_base, full_name, ref, name) for name in filenames]
+    if not urls:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(GITHUB_RAW_WORKERS, len(urls))) as pool:
+        contents = list(pool.map(get_raw_file, urls))
+    return dict(zip(filenames, contents))
+
+
 def POST(url, headers, data=None, params=None):
-    """post_url will use the requests library to post to a url
+    """post_url will use the GitHub client to post to a url
     """
     if data is not None:
-        return requests.post(url, headers=headers, data=json.dumps(data))
-    return requests.get(url, headers=headers)
+        return get_client().post(url, headers=headers, data=json.dumps(data))
+    return get_client().get(url, headers=headers)
 
 
 def DELETE(url, headers, data=None, params=None):
     """issue a delete reqest, with or without data and params.
     """
     if data is not None:
-        return requests.delete(url, headers=headers, data=json.dumps(data))
-    return requests.delete(url, headers=headers)
+        return get_client().delete(url, headers=headers, data=json.dumps(data))
+    return get_client().delete(url, headers=headers)
+
+
+################################################################################
+# CONDITIONAL REQUESTS
+################################################################################
+
+
+def get_cache_key(url, headers):
+    """a cached response is specific to the url, the authenticated identity
+       (we hash the token) and the media type requested.
+    """
+    identity = {
+        "url": url,
+        "auth": headers.get("Authorization"),
+        "accept": headers.get("Accept"),
+    }
+    return "%s:%s" % (cache_prefix, generate_sha256(identity))
+
+
+def read_content(response, max_size=None):
+    """read the content of a streamed response, raising a ValueError if
+       it is larger than max_size (bytes).
+    """
+    content = bytearray()
+    try:
+        for chunk in response.iter_content(chunk_size=8192):
+            content += chunk
+            if max_size is not None and len(content) > max_size:
+                raise ValueError("response is larger than %s bytes" % max_size)
+    finally:
+        response.close()
+    return bytes(content)
+
+
+def cached_response(response, cached):
+    """given a 304 (not modified) response and a cached entry, return a
+       response with the cached content that looks like a 200 to the caller.
+    """
+    headers = CaseInsensitiveDict(json.loads(cached[b"headers"].decode("utf-8")))
+    headers.update(response.headers)
+
+    result = requests.Response()
+    result.status_code = 200
+    result.headers = headers
+    result.url = response.url
+    result.request = response.request
+    result.encoding = "utf-8"
+    result._content = zlib.decompress(cached[b"content"])
+    return result
+
+
+def conditional_get(url, headers=None, max_size=None):
+    """a GET request that sends If-None-Match / If-Modified-Since when we
+       have a cached response for the url (and auth identity), and reuses
+       the cached content on a 304. GitHub doesn't count 304s against the
+       rate limit. Hits and misses are counted, see get_cache_stats. If
+       max_size is defined, a larger response raises a ValueError.
+    """
+    headers = dict(headers or {})
+    key = get_cache_key(url, headers)
+
+    try:
+        redis = get_redis()
+        cached = redis.hgetall(key)
+    except RedisError as exc:
+        print("Cache is unavailable: %s" % exc)
+        redis = None
+        cached = {}
+
+    if cached.get(b"etag"):
+        headers["If-None-Match"] = cached[b"etag"].decode("utf-8")
+    if cached.get(b"last_modified"):
+        headers["If-Modified-Since"] = cached[b"last_modified"].decode("utf-8")
+
+    response = get_client().get(url, headers=headers, stream=True)
+
+    if response.status_code == 304 and cached:
+        response.close()
+        count_cache(redis, "hits")
+        return cached_response(response, cached)
+
+    response._content = read_content(response, max_size)
+    count_cache(redis, "misses")
+
+    # Only successful responses with a validator can be reused
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if redis is not None and response.status_code == 200 and (etag or last_modified):
+        saved = {k: response.headers[k] for k in cache_headers if k in response.headers}
+        try:
+            pipeline = redis.pipeline()
+            pipeline.delete(key)
+            pipeline.hset(key, "etag", etag or "")
+            pipeline.hset(key, "last_modified", last_modified or "")
+            pipeline.hset(key, "headers", json.dumps(saved))
+            pipeline.hset(key, "content", zlib.compress(response.content))
+            pipeline.expire(key, GITHUB_CACHE_TTL)
+            pipeline.execute()
+        except RedisError as exc:
+            print("Cannot cache %s: %s" % (url, exc))
+
+    return response
+
+
+def count_cache(redis, name):
+    """increment a cache counter (hits or misses), if redis is available
+    """
+    if redis is not None:
+        try:
+            redis.incr("%s:%s" % (cache_prefix, name))
+        except RedisError:
+            pass
+
+
+def get_cache_stats():
+    """return the number of conditional request cache hits and misses
+    """
+    redis = get_redis()
+    stats = {}
+    for name in ["hits", "misses"]:
+        stats[name] = int(redis.get("%s:%s" % (cache_prefix, name)) or 0)
+    return stats
+
+
+################################################################################
+# PAGINATION
+################################################################################
 
 
 def format_params(url, params):
-    """format_params will add a list of params (?key=value) to a url
+    """format_params will add a list of params (?key=value) to a url,
+       replacing any that are already there.
 
        Parameters
        ==========
        params: a dictionary of params to add
        url: the url to add params to
     """
-    # Always try to get 100 per page
-    params["per_page"] = 100
-    count = 0
-    for param, value in params.items():
-        if count == 0:
-            url = "%s?%s=%s" % (url, param, value)
-        else:
-            url = "%s&%s=%s" % (url, param, value)
-        count += 1
-    return url
+    parsed = urlparse(url)
+    query = dict(parse_qsl(parsed.query))
+    query.update(params)
+    return urlunparse(parsed._replace(query=urlencode(query)))
 
 
-def paginate(url, headers, min_count=30, start_page=1, params=None, limit=None):
-    """paginate will send posts to a url with post_url
-       until the results count is not exceeded
+def get_page(url, headers):
+    """get a page of results, returning the response and the list of items
+       (empty if the request fails, e.g., bad credentials or an empty
+       repository, which return a dictionary).
+    """
+    response = conditional_get(url, headers=headers)
+    if response.status_code != 200:
+        return response, []
+    items = response.json()
+    if not isinstance(items, list):
+        return response, []
+    return response, items
+
+
+def get_page_urls(response):
+    """given the response for a page with a Link header for the next and
+       last pages, return the urls for the remaining pages. If there is no
+       last page (GitHub leaves it out for some endpoints) return None.
+    """
+    links = response.links
+    if "next" not in links or "last" not in links:
+        return
+
+    next_url = links["next"]["url"]
+    last_url = links["last"]["url"]
+    try:
+        first = int(dict(parse_qsl(urlparse(next_url).query))["page"])
+        last = int(dict(parse_qsl(urlparse(last_url).query))["page"])
+    except (KeyError, ValueError):
+        return
+    return [format_params(next_url, {"page": page}) for page in range(first, last + 1)]
+
+
+def paginate(url, headers, params=None, limit=None, workers=GITHUB_PAGE_WORKERS):
+    """paginate is a generator that yields results from a list endpoint as
+       they arrive. After the first page, when GitHub tells us the last page
+       the remaining pages are fetched concurrently (and yielded in order),
+       otherwise we follow the Link rel="next" header one page at a time.
 
        Parameters
-       ========== 
-       min_count: the results count to go to
-       start_page: the starting page
-    """
-    if params is None:
-        params = dict()
-    result = []
-    result_count = 1000
-    page = start_page
-    while result_count >= 30:
-
-        # If the user set a limit, honor it
-        if limit is not None:
-            if len(result) >= limit:
-                return result
-
-        params["page"] = page
-        paginated_url = format_params(url, params)
-        new_result = requests.get(paginated_url, headers=headers).json()
-        result_count = len(new_result)
-
-        # If the user triggers bad credentials, empty repository, stop
-        if isinstance(new_result, dict):
-            return result
-
-        result = result + new_result
-        page += 1
-    return result
+       ==========
+       url: the url of the list endpoint
+       headers: headers for the request (e.g., authentication)
+       params: a dictionary of additional params for the first page
+       limit: stop after yielding this many results
+       workers: the number of pages to fetch at once
+    """
+    params = dict(params or {})
+    params.setdefault("per_page", 100)
+
+    count = 0
+    response, items = get_page(format_params(url, params), headers)
+    while True:
+        for item in items:
+            if limit is not None and count >= limit:
+                return
+            yield item
+            count += 1
+
+        # Fetch the rest at once if we know how many pages there are
+        urls = get_page_urls(response)
+        if urls:
+            break
+
+        next_url = response.links.get("next", {}).get("url")
+        if not next_url or not items:
+            return
+        response, items = get_page(next_url, headers)
+
+    pool = ThreadPoolExecutor(max_workers=min(workers, len(urls)))
+    futures = [pool.submit(get_page, page_url, headers) for page_url in urls]
+    try:
+        for future in futures:
+            for item in future.result()[1]:
+                if limit is not None and count >= limit:
+                    return
+                yield item
+                count += 1
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
 
 
 def validate_payload(secret, payload, request_signature):
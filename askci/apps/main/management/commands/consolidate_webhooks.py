@@ -0,0 +1,58 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.core.management.base import BaseCommand
+from askci.apps.main.github import consolidate_webhooks
+from askci.apps.main.models import Article
+
+from datetime import timedelta
+import django_rq
+
+
+class Command(BaseCommand):
+    """Replace the three webhooks of older articles (push and deployment,
+       pull_request, and repository) with a single webhook. A job is
+       scheduled for each article, in batches spaced out in time. Each job
+       also waits for the owner's GitHub rate limit budget.
+    """
+
+    help = "Consolidate article webhooks into one per repository"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            dest="batch_size",
+            type=int,
+            default=50,
+            help="the number of articles to update at once",
+        )
+        parser.add_argument(
+            "--interval",
+            dest="interval",
+            type=int,
+            default=60,
+            help="seconds between batches",
+        )
+
+    def handle(self, *args, **options):
+        scheduler = django_rq.get_scheduler("default")
+        articles = Article.objects.filter(webhook__has_key="push-deploy").values_list(
+            "uuid", flat=True
+        )
+
+        count = 0
+        for count, article_uuid in enumerate(articles.iterator(), 1):
+            batch = (count - 1) // options["batch_size"]
+            scheduler.enqueue_in(
+                timedelta(seconds=batch * options["interval"]),
+                consolidate_webhooks,
+                article_uuid=article_uuid,
+            )
+        print("Scheduled webhook consolidation for %s articles" % count)
@@ -0,0 +1,37 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.core.management.base import BaseCommand
+from askci.apps.main.github.events import consume_webhooks
+
+import socket
+
+
+class Command(BaseCommand):
+    """Process GitHub webhook deliveries accepted by the webhook receiver.
+       Each delivery is resolved to an article, the repository metadata is
+       updated, and jobs are submit for the event. More than one consumer
+       can run at once, each with a different name, and deliveries left
+       pending by a consumer that stopped are claimed by the others.
+    """
+
+    help = "Process GitHub webhook deliveries"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--name",
+            dest="name",
+            default=socket.gethostname(),
+            help="the name of the consumer (defaults to the hostname)",
+        )
+
+    def handle(self, *args, **options):
+        print("Consuming webhooks as %s" % options["name"])
+        consume_webhooks(consumer=options["name"])
@@ -0,0 +1,78 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.core.management.base import BaseCommand
+from askci.apps.main.github.fake import serve
+
+
+class Command(BaseCommand):
+    """Run a local stand-in for the GitHub API and raw content, with a
+       number of article repositories for an owner. Set GITHUB_API_BASE and
+       GITHUB_RAW_BASE (printed on start) for the server and workers to use
+       it, e.g., to test imports and webhooks or to benchmark without
+       spending a real rate limit. POST /_fake/push/<repo> changes a
+       repository and delivers a signed push webhook.
+    """
+
+    help = "Run a fake GitHub API for testing and benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", dest="host", default="127.0.0.1")
+        parser.add_argument("--port", dest="port", type=int, default=9000)
+        parser.add_argument(
+            "--owner", dest="owner", default="askci", help="owner of the repositories"
+        )
+        parser.add_argument(
+            "--repos",
+            dest="repos",
+            type=int,
+            default=10,
+            help="number of article repositories to create",
+        )
+        parser.add_argument(
+            "--latency",
+            dest="latency",
+            type=float,
+            default=0,
+            help="seconds added to every response",
+        )
+        parser.add_argument(
+            "--jitter",
+            dest="jitter",
+            type=float,
+            default=0,
+            help="up to this many seconds added at random",
+        )
+        parser.add_argument(
+            "--error-rate",
+            dest="error_rate",
+            type=float,
+            default=0,
+            help="fraction of responses that are a 502",
+        )
+        parser.add_argument(
+            "--rate-limit",
+            dest="rate_limit",
+            type=int,
+            default=5000,
+            help="requests per hour for each token",
+        )
+
+    def handle(self, *args, **options):
+        serve(
+            host=options["host"],
+            port=options["port"],
+            owner=options["owner"],
+            repos=options["repos"],
+            latency=options["latency"],
+            jitter=options["jitter"],
+            error_rate=options["error_rate"],
+            rate_limit=options["rate_limit"],
+        )
@@ -0,0 +1,79 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from askci.apps.main.models import Article, Example
+from askci.apps.main.parser import highlighter_version
+from askci.apps.main.tasks import update_article
+
+import django_rq
+
+
+class Command(BaseCommand):
+    """Highlight stored example code to html with Pygments. By default,
+       only examples highlighted with a different version of the highlighter
+       or style (or not highlighted at all) are updated. Run this after
+       changing EXAMPLE_HIGHLIGHT_STYLE or upgrading Pygments.
+
+       The language of an example is parsed at ingest, and examples stored
+       before languages were parsed don't have one (it can't be recovered
+       from the stored text). With --reingest, a forced update_article is
+       submit for each article with examples missing a language, which
+       stores and highlights them with their language.
+    """
+
+    help = "Re-highlight stored example code"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            dest="force",
+            action="store_true",
+            default=False,
+            help="highlight everything, regardless of highlighter version",
+        )
+        parser.add_argument(
+            "--reingest",
+            dest="reingest",
+            action="store_true",
+            default=False,
+            help="re-ingest articles with examples that are missing a language",
+        )
+
+    def handle(self, *args, **options):
+        if options["reingest"]:
+            articles = Article.objects.filter(example__language__isnull=True).distinct()
+            count = 0
+            for count, article_uuid in enumerate(
+                articles.values_list("uuid", flat=True).iterator(), 1
+            ):
+                django_rq.enqueue(update_article, article_uuid=article_uuid, force=True)
+            print("Submit re-ingest for %s articles" % count)
+            return
+
+        examples = Example.objects.all()
+        if not options["force"]:
+            examples = examples.filter(
+                Q(renderer__isnull=True) | ~Q(renderer=highlighter_version)
+            )
+
+        batch = []
+        count = 0
+        for example in examples.iterator():
+            example.render()
+            batch.append(example)
+            if len(batch) >= 500:
+                Example.objects.bulk_update(batch, ["rendered", "renderer"])
+                count += len(batch)
+                batch = []
+        Example.objects.bulk_update(batch, ["rendered", "renderer"])
+        count += len(batch)
+        print("Highlighted %s examples with %s" % (count, highlighter_version))
@@ -0,0 +1,45 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.core.management.base import BaseCommand
+from askci.apps.main.models import Article
+from askci.apps.main.search import build_suggestions
+
+
+class Command(BaseCommand):
+    """Update the search vector for articles. Articles are indexed when they
+       are ingested or their tags change, so by default only articles that
+       haven't been indexed yet are updated. Run this with --all after
+       changing SEARCH_CONFIG or the weights in Article.update_search.
+       The typeahead index is rebuilt from the articles afterwards.
+    """
+
+    help = "Index articles for search"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            dest="all",
+            action="store_true",
+            default=False,
+            help="update all articles, not only those missing a search vector",
+        )
+
+    def handle(self, *args, **options):
+        articles = Article.objects.only("uuid")
+        if not options["all"]:
+            articles = articles.filter(search__isnull=True)
+
+        count = 0
+        for article in articles.iterator():
+            article.update_search()
+            count += 1
+        print("Indexed %s articles for search" % count)
+        build_suggestions()
@@ -0,0 +1,51 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from askci.apps.main.models import Article
+
+
+class Command(BaseCommand):
+    """Set the indexed repository id and full name for articles from the
+       repository metadata. Articles are kept in sync when they are saved,
+       so by default only articles that are missing them are updated.
+    """
+
+    help = "Index article repository ids and names"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            dest="all",
+            action="store_true",
+            default=False,
+            help="update all articles, not only those missing an index",
+        )
+
+    def handle(self, *args, **options):
+        articles = Article.objects.only("uuid", "repo", "repo_id", "repo_full_name")
+        if not options["all"]:
+            articles = articles.filter(
+                Q(repo_id__isnull=True) | Q(repo_full_name__isnull=True)
+            )
+
+        batch = []
+        count = 0
+        for article in articles.iterator():
+            article.sync_repo()
+            batch.append(article)
+            if len(batch) >= 500:
+                Article.objects.bulk_update(batch, ["repo_id", "repo_full_name"])
+                count += len(batch)
+                batch = []
+        Article.objects.bulk_update(batch, ["repo_id", "repo_full_name"])
+        count += len(batch)
+        print("Indexed repositories for %s articles" % count)
@@ -0,0 +1,48 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from askci.apps.main.models import Article
+from askci.apps.main.parser import renderer_version
+
+
+class Command(BaseCommand):
+    """Render stored article text to html. By default, only articles
+       rendered with a different version of the renderer (or not rendered
+       at all) are updated. Run this after changing the markdown renderer
+       or its extensions. Example code is highlighted separately, see
+       highlight_examples.
+    """
+
+    help = "Re-render stored article html"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            dest="force",
+            action="store_true",
+            default=False,
+            help="render everything, regardless of renderer version",
+        )
+
+    def handle(self, *args, **options):
+        articles = Article.objects.all()
+        if not options["force"]:
+            articles = articles.filter(
+                Q(renderer__isnull=True) | ~Q(renderer=renderer_version)
+            )
+
+        count = 0
+        for article in articles.iterator():
+            article.render()
+            article.save(update_fields=["rendered", "renderer"])
+            count += 1
+        print("Rendered %s articles with %s" % (count, renderer_version))
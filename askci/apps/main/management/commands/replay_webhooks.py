@@ -0,0 +1,65 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from askci.apps.main.github.events import replay_webhooks
+
+
+class Command(BaseCommand):
+    """Replay GitHub webhook deliveries received in a time range from the
+       replay log, e.g., after an outage of the consumer or a bug in
+       processing. Deliveries are added to the stream for consume_webhooks
+       again, without asking GitHub to redeliver each one.
+    """
+
+    help = "Replay GitHub webhook deliveries received between two times"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "start", help="replay deliveries received after (e.g., 2020-03-01T12:00)"
+        )
+        parser.add_argument(
+            "end", nargs="?", default=None, help="and before (defaults to now)"
+        )
+        parser.add_argument(
+            "--event",
+            dest="events",
+            action="append",
+            default=None,
+            help="only replay an event (e.g., push), can be used more than once",
+        )
+        parser.add_argument(
+            "--dry-run",
+            dest="dry_run",
+            action="store_true",
+            default=False,
+            help="list the deliveries without replaying them",
+        )
+
+    def get_datetime(self, value):
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise CommandError("%s is not a valid date and time" % value)
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+
+    def handle(self, *args, **options):
+        start = self.get_datetime(options["start"])
+        end = timezone.now()
+        if options["end"]:
+            end = self.get_datetime(options["end"])
+
+        count = replay_webhooks(
+            start, end, events=options["events"], dry_run=options["dry_run"]
+        )
+        print("Replayed %s deliveries" % count)
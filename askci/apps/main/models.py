@@ -9,10 +9,19 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """
 
 from django.db import models
+from django.db.models import Value
 from django.urls import reverse
 from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from askci.apps.main.parser import (
+    highlight_code,
+    highlighter_version,
+    parse_markdown,
+    renderer_version,
+)
+from askci.settings import SEARCH_CONFIG
 
-import markdown
 import uuid
 import re
 import time
@@ -93,6 +102,9 @@ class Tag(models.Model):
 
     class Meta:
         app_label = "main"
+        indexes = [
+            GinIndex(fields=["tag"], name="tag_trgm", opclasses=["gin_trgm_ops"])
+        ]
 
 
 class Question(models.Model):
@@ -147,11 +159,17 @@ class Question(models.Model):
     class Meta:
         app_label = "main"
         unique_together = ["article", "text"]
+        indexes = [
+            GinIndex(
+                fields=["text"], name="question_text_trgm", opclasses=["gin_trgm_ops"]
+            )
+        ]
 
 
 class Example(models.Model):
     """An example corresponds to a block of code to illustrate an idea.
-       If a language is provided or detected, we include it. 
+       If a language is provided or detected, we include it, and use it
+       to highlight the code when the example is saved by update_article.
     """
 
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -163,16 +181,30 @@ class Example(models.Model):
         "Article", on_delete=models.CASCADE, blank=True, null=True
     )
 
+    language = models.CharField(max_length=250, blank=True, null=True)
+
+    # Code highlighted at ingest time, and the version of the highlighter used
+    rendered = models.TextField(blank=True, null=True)
+    renderer = models.CharField(max_length=250, blank=True, null=True)
+
     def __str__(self):
         return "<Example:%s>" % self.text
 
     def __repr__(self):
         return self.__str__()
 
+    def render(self):
+        """highlight code to html to store with the example (this doesn't save).
+        """
+        self.rendered = highlight_code(self.code, self.language)
+        self.renderer = highlighter_version
+
     def code2html(self):
-        """render code to html, usually for a front end view. 
+        """return code rendered to html, usually for a front end view. 
         """
-        return markdown.markdown(self.code)
+        if self.rendered is None:
+            self.render()
+        return self.rendered
 
     @property
     def pretty(self):
@@ -225,6 +257,16 @@ class Article(models.Model):
     commit = models.CharField(max_length=250, blank=True, null=True)
     summary = models.TextField(blank=True, null=True)
     text = models.TextField(blank=True, null=True)
+
+    # Text rendered to html at ingest time, and the version of the renderer used
+    rendered = models.TextField(blank=True, null=True)
+    renderer = models.CharField(max_length=250, blank=True, null=True)
+
+    # Hash of the fetched content (and template files) and the commit it was
+    # ingested at, used to skip re-parsing when a push doesn't change content
+    content_hash = models.CharField(max_length=250, blank=True, null=True)
+    content_commit = models.CharField(max_length=250, blank=True, null=True)
+
     template = models.ForeignKey(
         "TemplateRepository", on_delete=models.SET_NULL, blank=True, null=True
     )
@@ -238,6 +280,17 @@ class Article(models.Model):
     repo = JSONField(default=dict)
     webhook = JSONField(default=dict)
 
+    # Indexed copies of the repository id and full name (set from repo on
+    # save) to look up an article for a webhook without scanning repo
+    repo_id = models.BigIntegerField(blank=True, null=True, db_index=True)
+    repo_full_name = models.CharField(
+        max_length=250, blank=True, null=True, db_index=True
+    )
+
+    # Weighted full text of the name, tags, summary, and text, maintained by
+    # update_search when an article is ingested or its tags change
+    search = SearchVectorField(blank=True, null=True)
+
     # Tags are additional terms to describe an article
     tags = models.ManyToManyField(
         "main.Tag",
@@ -249,8 +302,18 @@ class Article(models.Model):
 
     @property
     def html(self):
-        if self.text:
-            return markdown.markdown(self.text)
+        """return the html rendered at ingest time, falling back to rendering
+           (without saving) for an article that hasn't been rendered yet.
+        """
+        if self.rendered is None and self.text:
+            self.render()
+        return self.rendered
+
+    def render(self):
+        """render the article text to html to store (this doesn't save).
+        """
+        self.rendered = parse_markdown(self.text).html
+        self.renderer = renderer_version
 
     @property
     def pull_requests(self):
@@ -270,12 +333,34 @@ class Article(models.Model):
         for tag in get_repository_topics(self.owner, self.repo):
             tag, created = Tag.objects.get_or_create(tag=tag)
             self.tags.add(tag)
-        self.save()
+        self.save(update_fields=["modified"])
 
         # For any previous tag no longer used, delete
         for tag in previous_tags:
             if tag.article_tags.count() == 0:
                 tag.delete()
+        self.update_search()
+
+    def update_search(self):
+        """update the search vector for the article from the current name,
+           tags, summary, and text in one query (this doesn't save). Matches
+           in the name rank highest, followed by tags, summary, and text.
+           Cached search results are invalidated.
+        """
+        from askci.apps.main.search import invalidate_search_cache
+
+        tags = " ".join(self.tags.values_list("tag", flat=True))
+        Article.objects.filter(pk=self.pk).update(
+            search=SearchVector("name", weight="A", config=SEARCH_CONFIG)
+            + SearchVector(
+                Value(tags, output_field=models.TextField()),
+                weight="B",
+                config=SEARCH_CONFIG,
+            )
+            + SearchVector("summary", weight="C", config=SEARCH_CONFIG)
+            + SearchVector("text", weight="D", config=SEARCH_CONFIG)
+        )
+        invalidate_search_cache()
 
     def archive(self, reason):
         """At any point when we cannot perform an action, either the repository
@@ -286,7 +371,7 @@ class Article(models.Model):
 
         if not self.archived:
             self.archived = True
-            self.save()
+            self.save(update_fields=["archived", "modified"])
 
             # Only send email if respository not archived yet
             if article.owner.email:
@@ -317,8 +402,24 @@ class Article(models.Model):
 
         if self.pk is None:
             self.tag = lowercase_cleaned_name(self.tag)
+
+        # Keep the indexed repository fields in sync with repo
+        self.sync_repo()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "repo" in update_fields:
+            kwargs["update_fields"] = list(update_fields) + [
+                "repo_id",
+                "repo_full_name",
+            ]
         return super(Article, self).save(*args, **kwargs)
 
+    def sync_repo(self):
+        """set the indexed repository id and full name from repo, which
+           changes when a repository is renamed or transferred.
+        """
+        self.repo_id = (self.repo or {}).get("id")
+        self.repo_full_name = (self.repo or {}).get("full_name")
+
     def __str__(self):
         return "<Article:%s>" % self.name
 
@@ -333,6 +434,12 @@ class Article(models.Model):
 
     class Meta:
         app_label = "main"
+        indexes = [
+            GinIndex(fields=["search"]),
+            GinIndex(
+                fields=["name"], name="article_name_trgm", opclasses=["gin_trgm_ops"]
+            ),
+        ]
 
 
 class PullRequest(models.Model):
@@ -374,3 +481,52 @@ class PullRequest(models.Model):
 
     class Meta:
         app_label = "main"
+
+
+class TemplateUpdate(models.Model):
+    """A template update is a request (by staff) to update a set of articles
+       from their templates, which sends a dispatch event to each article
+       repository. The result for each article (the status code of the
+       dispatch, or why it was skipped) is saved after each batch, so
+       progress can be seen in the admin and an update can be resumed.
+    """
+
+    STATUS_OPTIONS = [
+        ("pending", "pending"),
+        ("running", "running"),
+        ("finished", "finished"),
+    ]
+
+    uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created = models.DateTimeField("date created", auto_now_add=True)
+    modified = models.DateTimeField("date modified", auto_now=True)
+    status = models.CharField(max_length=32, choices=STATUS_OPTIONS, default="pending")
+    owner = models.ForeignKey(
+        "users.User", on_delete=models.SET_NULL, blank=True, null=True
+    )
+
+    # Names of articles to update, and the result for each one done
+    articles = JSONField(default=list)
+    results = JSONField(default=dict)
+
+    def __str__(self):
+        return "<TemplateUpdate:%s>" % self.uuid
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def remaining(self):
+        """the names of articles that haven't been updated yet
+        """
+        return [name for name in self.articles if name not in self.results]
+
+    @property
+    def progress(self):
+        return "%s of %s" % (len(self.results), len(self.articles))
+
+    def get_label(self):
+        return "templateupdate"
+
+    class Meta:
+        app_label = "main"
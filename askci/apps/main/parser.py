@@ -0,0 +1,245 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from askci.settings import EXAMPLE_HIGHLIGHT_STYLE
+
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
+from markdown.util import HTML_PLACEHOLDER_RE
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name, TextLexer
+from pygments.util import ClassNotFound
+
+import html
+import markdown
+import pygments
+import re
+
+# Bump the parser version when rendering changes, to re-render stored html
+# with python manage.py render_articles
+parser_version = "1"
+renderer_version = "askci-%s-markdown-%s" % (parser_version, markdown.__version__)
+
+# Example code is highlighted with Pygments, re-highlight with highlight_examples
+highlighter_version = "pygments-%s-%s" % (pygments.__version__, EXAMPLE_HIGHLIGHT_STYLE)
+
+# Supported span prefixes
+prefixes = ["question", "example"]
+prefix_regex = "^(%s)" % "|".join(prefixes)
+
+span_regex = re.compile("<span\\b[^>]*>", re.IGNORECASE)
+identifier_regex = re.compile(
+    "\\sid\\s*=\\s*(?:\"([^\"]*)\"|'([^']*)'|([^\\s>]+))", re.IGNORECASE
+)
+
+
+def split_language(code):
+    """if the code starts with a single term on the first line, assume it's
+       a language and remove it. We will need to test this to see if it works
+       in practice. Returns the language (None if Pygments doesn't know it)
+       and the code without it.
+    """
+    language = None
+    lines = code.split("\n")
+    if len(lines) > 1:
+        words = lines[0].split(" ")
+        if len(words) == 1:
+            lines = lines[1:]
+            code = "\n".join(lines)
+            try:
+                language = get_lexer_by_name(words[0].strip()).aliases[0]
+            except ClassNotFound:
+                pass
+    return language, code
+
+
+def remove_language(code):
+    """remove a language from the first line of code, if there is one.
+    """
+    return split_language(code)[1]
+
+
+class SpanTreeprocessor(Treeprocessor):
+    """Walk the rendered element tree in document order, and collect the
+       <span> tags found in raw html (stashed by the html processors) along
+       with the text of the first code element that follows each one. This
+       runs after inline processing, so code elements exist and the raw
+       html is still available as placeholders in element text.
+    """
+
+    def run(self, root):
+        self.spans = []
+        self.pending = []
+        self.visit(root)
+        self.md.spans = self.spans
+
+    def visit(self, element):
+        if element.tag == "code":
+            self.add_code(element.text or "")
+        else:
+            self.add_text(element.text)
+
+        for child in element:
+            self.visit(child)
+            self.add_text(child.tail)
+
+    def add_text(self, text):
+        """find html placeholders in text, and record spans in the raw html
+        """
+        if not text:
+            return
+
+        for match in HTML_PLACEHOLDER_RE.finditer(text):
+            index = int(match.group(1))
+            if index >= len(self.md.htmlStash.rawHtmlBlocks):
+                continue
+            raw = self.md.htmlStash.rawHtmlBlocks[index]
+            if not isinstance(raw, str):
+                continue
+
+            for tag in span_regex.findall(raw):
+                identifier = None
+                match = identifier_regex.search(tag)
+                if match:
+                    value = [group for group in match.groups() if group is not None]
+                    identifier = html.unescape(value[0])
+                span = {"span": tag, "id": identifier, "code": None}
+                self.spans.append(span)
+                self.pending.append(span)
+
+    def add_code(self, text):
+        """code is escaped by the markdown processors, so we unescape it
+           and give it to any spans that are still waiting for code.
+        """
+        code = html.unescape(text)
+        for span in self.pending:
+            span["code"] = code
+        self.pending = []
+
+
+class SpanExtension(Extension):
+    """A Python-Markdown extension to collect question and example spans
+       while rendering, so we don't need to parse the html a second time.
+    """
+
+    def extendMarkdown(self, md):
+        self.md = md
+        md.registerExtension(self)
+        md.treeprocessors.register(SpanTreeprocessor(md), "askci_spans", 15)
+        md.spans = []
+
+    def reset(self):
+        self.md.spans = []
+
+
+class ParsedMarkdown:
+    """The result of parsing markdown for an article: the rendered html,
+       if the spans are valid (and a message if not), and the questions
+       and examples (identifier -> code) that were found.
+    """
+
+    def __init__(self, html, spans):
+        self.html = html
+        self.spans = spans
+        self.valid, self.message = self.validate()
+
+    def __str__(self):
+        return "<ParsedMarkdown:%s>" % self.message
+
+    def __repr__(self):
+        return self.__str__()
+
+    def validate(self):
+        """Ensure that each span is all lowercase, with no extra characters
+        """
+        for span in self.spans:
+            identifier = span["id"]
+
+            # The span is required to have an id
+            if not identifier:
+                return False, "Span %s is missing an identifier." % span["span"]
+
+            # The span id must start with a valid prefix
+            if not re.search(prefix_regex, identifier):
+                return (
+                    False,
+                    "Span %s does not start with %s" % (identifier, prefix_regex),
+                )
+
+            # The span id must have all lowercase, no special characters or spaces
+            if re.search("[^A-Za-z0-9-]+", identifier):
+                return (
+                    False,
+                    "Span %s is invalid: can only have lowercase and '-'" % identifier,
+                )
+
+        return True, "Valid"
+
+    def valid_spans(self):
+        """yield spans with an identifier that is correctly formatted
+        """
+        for span in self.spans:
+            identifier = span["id"]
+            if not identifier or not re.search(prefix_regex, identifier):
+                continue
+            if re.search("[^A-Za-z0-9-]+", identifier):
+                continue
+            yield span
+
+    @property
+    def questions(self):
+        """a list of unique question identifiers, in the order they are found
+        """
+        questions = []
+        for span in self.valid_spans():
+            identifier = span["id"]
+            if identifier.startswith("question") and identifier not in questions:
+                questions.append(identifier)
+        return questions
+
+    @property
+    def examples(self):
+        """a dictionary of example identifiers, each with code and the
+           detected language. Examples are only included if found before
+           a code section.
+        """
+        examples = {}
+        for span in self.valid_spans():
+            identifier = span["id"]
+            if not identifier.startswith("example") or identifier in examples:
+                continue
+            if span["code"] is not None:
+                language, code = split_language(span["code"])
+                examples[identifier] = {"code": code, "language": language}
+        return examples
+
+
+def highlight_code(code, language=None):
+    """highlight example code to html with Pygments, using inline styles so
+       the html can be served as is. Code without a known language is
+       rendered as plain text.
+    """
+    lexer = TextLexer()
+    if language:
+        try:
+            lexer = get_lexer_by_name(language)
+        except ClassNotFound:
+            pass
+    formatter = HtmlFormatter(style=EXAMPLE_HIGHLIGHT_STYLE, noclasses=True)
+    return pygments.highlight(code or "", lexer, formatter)
+
+
+def parse_markdown(text):
+    """render markdown text to html, and validate and extract question and
+       example spans in the same pass.
+    """
+    md = markdown.Markdown(extensions=[SpanExtension()])
+    html = md.convert(text or "")
+    return ParsedMarkdown(html, md.spans)
@@ -0,0 +1,310 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.contrib.postgres.lookups import PostgresSimpleLookup
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connection
+from django.urls import reverse
+from askci.apps.main.models import Article, Question, Tag
+from askci.apps.main.utils import generate_sha256, get_redis
+from askci.settings import (
+    SEARCH_CACHE_LOCK_TIMEOUT,
+    SEARCH_CACHE_TTL,
+    SEARCH_SIMILARITY,
+    SEARCH_SUGGEST_DELAY,
+    SEARCH_SUGGEST_LIMIT,
+    SEARCH_SUGGEST_PREFIX_LENGTH,
+    SEARCH_SUGGESTION_WORDS,
+    SEARCH_WORD_SIMILARITY,
+)
+
+from datetime import timedelta
+from redis.exceptions import LockError, RedisError
+import django_rq
+import json
+import re
+
+# Cached search results are kept under the current corpus generation, which
+# is incremented when articles, questions, or tags change
+search_cache_prefix = "askci:search:cache"
+search_generation_key = "askci:search:generation"
+
+# Typeahead suggestions are kept in a sorted set for each prefix, under a
+# version that is replaced when the index is rebuilt
+suggest_prefix = "askci:suggest"
+suggest_version_key = "askci:suggest:version"
+suggest_pending_key = "askci:suggest:pending"
+
+# Articles are suggested before tags, and tags before questions
+suggest_weights = {"article": 3, "tag": 2, "question": 1}
+
+
+class TrigramWordSimilar(PostgresSimpleLookup):
+    """field__trigram_word_similar=q matches when q is similar to a word (or
+       run of words) in the field, using the %> operator of pg_trgm. Unlike
+       trigram_similar, a short query can match a long field such as a
+       question, and it can use a gin_trgm_ops index.
+    """
+
+    lookup_name = "trigram_word_similar"
+    operator = "%%>"
+
+
+def create_trigram_extension(sender, using, **kwargs):
+    """pre_migrate receiver to enable pg_trgm before trigram indexes (with
+       the gin_trgm_ops operator class) are created. This needs a database
+       user that can create the extension, or for it to exist already.
+    """
+    from django.db import connections
+
+    with connections[using].cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+
+def set_similarity():
+    """set the thresholds for the trigram operators (% and %>) for the
+       connection. The defaults (0.3 and 0.6) miss short misspellings like
+       "slrum" for "slurm".
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SET pg_trgm.similarity_threshold = %s", [SEARCH_SIMILARITY])
+        cursor.execute(
+            "SET pg_trgm.word_similarity_threshold = %s", [SEARCH_WORD_SIMILARITY]
+        )
+
+
+def suggest_word(word):
+    """return the article name or tag most similar to a word, or None if
+       nothing is within the similarity threshold. Both lookups use the
+       trigram indexes, so this is a single cheap query.
+    """
+    names = (
+        Article.objects.filter(archived=False, name__trigram_similar=word)
+        .annotate(similarity=TrigramSimilarity("name", word))
+        .values_list("name", "similarity")
+    )
+    tags = (
+        Tag.objects.filter(tag__trigram_similar=word)
+        .annotate(similarity=TrigramSimilarity("tag", word))
+        .values_list("tag", "similarity")
+    )
+    best = names.union(tags).order_by("-similarity")[:1]
+    if best:
+        return best[0][0]
+
+
+def suggest_query(q):
+    """return a "did you mean" query for a search that had no results, with
+       each word replaced by the most similar article name or tag, or None
+       if there isn't a different suggestion.
+    """
+    words = re.findall("[A-Za-z0-9:-]+", q.lower())[:SEARCH_SUGGESTION_WORDS]
+    if not words:
+        return
+
+    set_similarity()
+    suggestion = [suggest_word(word) or word for word in words]
+    if suggestion != words:
+        return " ".join(suggestion)
+
+
+def normalize_query(q):
+    """normalize a query for the cache: searches are case insensitive, and
+       extra whitespace doesn't change the results.
+    """
+    return " ".join(q.lower().split())
+
+
+def invalidate_search_cache():
+    """invalidate all cached search results by moving to a new generation.
+       Entries for older generations are never read again and expire. The
+       typeahead index is rebuilt too, see schedule_build_suggestions.
+    """
+    try:
+        get_redis().incr(search_generation_key)
+        schedule_build_suggestions()
+    except RedisError as exc:
+        print("Could not invalidate search cache: %s" % exc)
+
+
+def get_cached_search(params, search):
+    """return the result of search() for a dictionary of search parameters,
+       cached for the current generation. When many requests miss the
+       same entry at once, one computes it while the rest wait on a lock
+       and then read it. If redis isn't available, search() is returned
+       directly. The result must be serializable as json.
+    """
+    try:
+        redis = get_redis()
+        generation = int(redis.get(search_generation_key) or 0)
+        key = "%s:%s:%s" % (search_cache_prefix, generation, generate_sha256(params))
+        cached = redis.get(key)
+        if cached is not None:
+            return json.loads(cached.decode("utf-8"))
+
+        lock = redis.lock(
+            "%s:lock" % key,
+            timeout=SEARCH_CACHE_LOCK_TIMEOUT,
+            blocking_timeout=SEARCH_CACHE_LOCK_TIMEOUT,
+        )
+        locked = lock.acquire()
+    except RedisError:
+        return search()
+
+    try:
+        # Another request may have computed it while we waited
+        try:
+            cached = redis.get(key)
+        except RedisError:
+            return search()
+        if cached is not None:
+            return json.loads(cached.decode("utf-8"))
+
+        result = search()
+        try:
+            redis.set(key, json.dumps(result), ex=SEARCH_CACHE_TTL)
+        except RedisError:
+            pass
+        return result
+    finally:
+        if locked:
+            try:
+                lock.release()
+            except (LockError, RedisError):
+                pass
+
+
+def normalize_suggestion(text):
+    """normalize text for the typeahead index and queries
+    """
+    return " ".join(text.lower().split())[:SEARCH_SUGGEST_PREFIX_LENGTH]
+
+
+def get_prefixes(text):
+    """return the prefixes to index a suggestion under: the start of the
+       text and of each word in it (so "slu" suggests "What is slurm?"),
+       up to SEARCH_SUGGEST_PREFIX_LENGTH characters.
+    """
+    text = " ".join(text.lower().split())
+    prefixes = set()
+    for match in re.finditer("[a-z0-9]+", text):
+        start = text[match.start() : match.start() + SEARCH_SUGGEST_PREFIX_LENGTH]
+        prefixes.update(start[:length] for length in range(1, len(start) + 1))
+    return prefixes
+
+
+def get_suggestion_terms():
+    """yield the label, text, and url of each article name, tag, and question
+       to suggest.
+    """
+    for name in Article.objects.filter(archived=False).values_list("name", flat=True):
+        yield "article", name, reverse("article_details", args=[name])
+
+    for tag in Tag.objects.values_list("tag", flat=True):
+        yield "tag", tag, reverse("tag_details", args=[tag])
+
+    questions = Question.objects.filter(article__archived=False).select_related(
+        "article"
+    )
+    for question in questions.only("text", "article__name").iterator():
+        yield "question", question.pretty, question.get_absolute_url()
+
+
+def build_suggestions():
+    """build the typeahead index: for each prefix, a sorted set of (at most
+       SEARCH_SUGGEST_LIMIT) suggestions, ordered by weight and then text.
+       The index is built under a new version, which replaces the current
+       version when it's complete, and the previous version is deleted.
+    """
+    redis = get_redis()
+    redis.delete(suggest_pending_key)
+    version = redis.incr("%s:builds" % suggest_prefix)
+    keys_key = "%s:%s:keys" % (suggest_prefix, version)
+
+    count = 0
+    pipeline = redis.pipeline(transaction=False)
+    for label, text, url in get_suggestion_terms():
+        member = json.dumps([label, text, url])
+        for prefix in get_prefixes(text):
+            key = "%s:%s:%s" % (suggest_prefix, version, prefix)
+            pipeline.zadd(key, {member: -suggest_weights[label]})
+            pipeline.sadd(keys_key, key)
+        count += 1
+        if len(pipeline) >= 5000:
+            pipeline.execute()
+    pipeline.execute()
+
+    # Keep only the top suggestions for each prefix
+    for key in redis.sscan_iter(keys_key, count=1000):
+        pipeline.zremrangebyrank(key, SEARCH_SUGGEST_LIMIT, -1)
+        if len(pipeline) >= 5000:
+            pipeline.execute()
+    pipeline.execute()
+
+    previous = redis.getset(suggest_version_key, version)
+    if previous is not None:
+        delete_suggestions(int(previous))
+    print("Indexed %s suggestions for typeahead" % count)
+    return count
+
+
+def delete_suggestions(version):
+    """delete the keys for a version of the typeahead index
+    """
+    redis = get_redis()
+    keys_key = "%s:%s:keys" % (suggest_prefix, version)
+    pipeline = redis.pipeline(transaction=False)
+    for key in redis.sscan_iter(keys_key, count=1000):
+        pipeline.delete(key)
+        if len(pipeline) >= 5000:
+            pipeline.execute()
+    pipeline.delete(keys_key)
+    pipeline.execute()
+
+
+def schedule_build_suggestions():
+    """schedule build_suggestions after SEARCH_SUGGEST_DELAY seconds, unless
+       a build is already waiting, so that a burst of changes (e.g., a bulk
+       import) rebuilds the index once.
+    """
+    redis = get_redis()
+    if redis.set(suggest_pending_key, 1, nx=True, ex=SEARCH_SUGGEST_DELAY * 10):
+        scheduler = django_rq.get_scheduler("default")
+        scheduler.enqueue_in(timedelta(seconds=SEARCH_SUGGEST_DELAY), build_suggestions)
+
+
+def get_suggestions(q, limit=SEARCH_SUGGEST_LIMIT):
+    """return up to limit suggestions (label, text, and url) for what has
+       been typed so far, from the typeahead index. This is two lookups in
+       redis, and never touches the database. If redis is unavailable,
+       there are no suggestions.
+    """
+    typed = " ".join(q.lower().split())
+    prefix = normalize_suggestion(q)
+    if not prefix:
+        return []
+
+    try:
+        redis = get_redis()
+        version = redis.get(suggest_version_key)
+        if version is None:
+            return []
+        key = "%s:%s:%s" % (suggest_prefix, version.decode("utf-8"), prefix)
+        members = redis.zrange(key, 0, min(limit, SEARCH_SUGGEST_LIMIT) - 1)
+    except RedisError:
+        return []
+
+    # Past the longest prefix indexed, suggestions must contain all of it
+    suggestions = []
+    for member in members:
+        label, text, url = json.loads(member.decode("utf-8"))
+        if typed == prefix or typed in " ".join(text.lower().split()):
+            suggestions.append({"label": label, "text": text, "url": url})
+    return suggestions
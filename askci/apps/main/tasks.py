@@ -9,32 +9,44 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """
 
 from django.conf import settings
-from askci.apps.main.models import Article, Question, Example, PullRequest, Tag
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from askci.apps.main.models import (
+    Article,
+    Example,
+    PullRequest,
+    Question,
+    Tag,
+    TemplateRepository,
+)
+from askci.apps.main.parser import parse_markdown, renderer_version
+from askci.apps.main.utils import generate_sha256, get_redis
 from askci.apps.users.models import User
-
-from bs4 import BeautifulSoup
-from itertools import chain
-
-import markdown
+from askci.settings import (
+    ARTICLE_JOB_TIMEOUT,
+    ARTICLE_UPDATE_DELAY,
+    ARTICLE_UPDATE_LOCK_TIMEOUT,
+    BULK_IMPORT_BATCH_SIZE,
+    BULK_IMPORT_WORKERS,
+)
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from redis.exceptions import LockError
+from rq import get_current_job
+
+import django_rq
 import json
 import os
-import re
-import requests
 import sys
+import uuid
 
+# Pending updates, locks, and counters for update_article (per article)
+article_update_prefix = "askci:article:update"
+article_update_stats = "askci:article:update:stats"
 
-def remove_language(code):
-    """if the code starts with a single term on the first line, assume it's
-       a language and remove it. We will need to test this to see if it works
-       in practice.
-    """
-    lines = code.split("\n")
-    if len(lines) > 1:
-        words = lines[0].split(" ")
-        if len(words) == 1:
-            lines = lines[1:]
-            code = "\n".join(lines)
-    return code
+# Locks for creating an article for a term, see add_article
+article_term_prefix = "askci:article:term"
 
 
 def repository_change(article_uuid, action, repo):
@@ -44,17 +56,31 @@ def repository_change(article_uuid, action, repo):
 
        https://developer.github.com/v3/activity/events/types/#repositoryevent
     """
+    from askci.apps.main.github import defer_for_budget
+
     try:
         article = Article.objects.get(uuid=article_uuid)
     except Article.DoesNotExist:
         return
 
+    # Wait for the rate limit to reset if interactive requests need it
+    if defer_for_budget(
+        article.owner,
+        repository_change,
+        article_uuid=article_uuid,
+        action=action,
+        repo=repo,
+    ):
+        return
+
+    # Only the fields changed here are saved, an ingestion may be running
     article.repo = json.loads(repo)
+    article.save(update_fields=["repo", "modified"])
 
     # Not archived
     if action in ["created", "unarchived", "publicized"]:
         article.archived = False
-        article.save()
+        article.save(update_fields=["archived", "modified"])
 
     # Reason for archive
     elif action in ["deleted", "archived", "privatized"]:
@@ -62,7 +88,7 @@ def repository_change(article_uuid, action, repo):
 
     # If repository is renamed, must begin with "askci-term" or is archived
     elif action in ["renamed"]:
-        if not repo["name"].startswith("askci-term-"):
+        if not article.repo["name"].startswith("askci-term-"):
             article.archive("the repository name needs to start with askci-term-. ")
 
     article.update_tags()
@@ -138,130 +164,478 @@ def update_tag(article_uuid, tag, event):
     if event == "create":
         if tag not in article.tags.all():
             article.tags.add(tag)
-            article.save()
+            article.save(update_fields=["modified"])
 
     # Delete a tag (and permanently from AskCI) if removed
     elif event == "delete":
         if tag in article.tags.all():
             article.tags.remove(tag)
-            article.save()
+            article.save(update_fields=["modified"])
         if tag.article_tags.count() == 0:
             tag.delete()
 
+    article.update_search()
 
-def update_article(article_uuid):
+
+def update_job_meta(job=None, **kwargs):
+    """update the metadata of the currently running job (or another job), if
+       there is one, so the result of a task (e.g., a skipped ingestion) can
+       be inspected from the django-rq dashboard.
+    """
+    job = job or get_current_job()
+    if job is not None:
+        job.meta.update(kwargs)
+        job.save_meta()
+
+
+def schedule_article_update(article_uuid):
+    """schedule update_article for an article after ARTICLE_UPDATE_DELAY
+       seconds. If an update is already waiting for the article (e.g., from
+       the previous push in a burst) it's replaced, so one ingestion runs for
+       the latest commit. Replaced jobs are counted as coalesced.
+    """
+    scheduler = django_rq.get_scheduler("default")
+    job = scheduler.enqueue_in(
+        timedelta(seconds=ARTICLE_UPDATE_DELAY),
+        update_article,
+        article_uuid=article_uuid,
+    )
+
+    redis = get_redis()
+    key = "%s:pending:%s" % (article_update_prefix, article_uuid)
+    pipeline = redis.pipeline()
+    pipeline.getset(key, job.id)
+    pipeline.expire(key, ARTICLE_UPDATE_DELAY * 2)
+    pending = pipeline.execute()[0]
+
+    if pending is not None and pending.decode("utf-8") in scheduler:
+        scheduler.cancel(pending.decode("utf-8"))
+        redis.hincrby(article_update_stats, "coalesced", 1)
+    redis.hincrby(article_update_stats, "scheduled", 1)
+    return job
+
+
+def get_article_update_stats():
+    """return counts of scheduled and coalesced article updates
+    """
+    stats = get_redis().hgetall(article_update_stats)
+    return {k.decode("utf-8"): int(v) for k, v in stats.items()}
+
+
+def update_article(article_uuid, force=False):
     """take a request and an associated article, and grab
        the latest README to update content on the site.
        If the content isn't valid, we don't update. The same test
        is done when the user submits **and** with a GitHub workflow,
-       so this case is unlikely (but maybe possible).
+       so this case is unlikely (but maybe possible). Ingestion is
+       content addressed: if the commit was already ingested, or the
+       fetched content (and template files) hash to the same value that
+       we last parsed, we skip parsing, saving questions, and tags.
+       Set force to True to ingest regardless. Webhooks schedule this with
+       schedule_article_update, so a burst of pushes runs it once.
     """
+    from askci.apps.main.github import defer_for_budget
+
     try:
         article = Article.objects.get(uuid=article_uuid)
     except Article.DoesNotExist:
         return
 
-    # For now just use the first file, we know to feed that into content
-    # If there are other templates with multiple files, they could
-    # be looped over here.
-    filename = "README.md"
-    if article.template.files:
-        filename = article.template.files.split(" ")[0]
-
-    # Formulate the url for raw github content
-    url = "https://raw.githubusercontent.com/%s/master/%s" % (
-        article.repo["full_name"],
-        filename,
+    # Wait for the rate limit to reset if interactive requests need it
+    if defer_for_budget(
+        article.owner, update_article, article_uuid=article_uuid, force=force
+    ):
+        update_job_meta(deferred=True)
+        return
+
+    # One ingestion per article runs at a time, a push during it runs after
+    lock = get_redis().lock(
+        "%s:lock:%s" % (article_update_prefix, article_uuid),
+        timeout=ARTICLE_UPDATE_LOCK_TIMEOUT,
     )
-    content = requests.get(url).text
+    if not lock.acquire(blocking=False):
+        schedule_article_update(article_uuid)
+        update_job_meta(skipped=True, reason="update in progress, rescheduled")
+        return
 
-    # Test markdown first - don't continue if not valid
-    valid, message = test_markdown(content)
-    if not valid:
-        print("Markdown is invalid: %s" % message)
+    try:
+        article.refresh_from_db()
+        ingest_article(article, force=force)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            print("Lock for %s expired during update" % article_uuid)
+
+
+def ingest_article(article, force=False):
+    """fetch, parse, and save the content for an article. This is called by
+       update_article, which holds the lock for the article.
+    """
+    # If the commit was already ingested, we don't need to fetch anything
+    if (
+        not force
+        and article.content_hash
+        and article.commit
+        and article.commit == article.content_commit
+    ):
+        update_job_meta(skipped=True, reason="commit already ingested")
         return
 
-    # Parse the content for questions
-    html = markdown.markdown(content)
-    soup = BeautifulSoup(html, "lxml")
+    # All files in the template are fetched and merged into the content
+    files = "README.md"
+    if article.template and article.template.files:
+        files = article.template.files
+    filenames = [filename for filename in files.split(" ") if filename]
 
-    # Supported span prefixes
-    prefixes = ["question", "example"]
-    prefix_regex = "^(%s)" % "|".join(prefixes)
+    # Get raw github content, at the commit if we know it. A push during
+    # ingestion saves a newer commit, which is ingested by the next update
+    from askci.apps.main.github.utils import get_raw_files
 
-    # Keep link to previous questions (and empty article)
-    previous = list(chain(article.question_set.all(), article.example_set.all()))
-    article.question_set.clear()
-    article.example_set.clear()
-    [p.delete() for p in previous]
+    commit = article.commit
+    contents = get_raw_files(
+        article.repo["full_name"], filenames, ref=commit or "master"
+    )
 
-    # Add correctly formatted spans (this is same as testing in repository)
-    for span in soup.find_all("span"):
+    # Don't continue with partial content
+    missing = [filename for filename, text in contents.items() if text is None]
+    if missing:
+        print("Could not retrieve %s" % ", ".join(missing))
+        update_job_meta(skipped=True, reason="missing %s" % ", ".join(missing))
+        return
 
-        # The span is required to have an id
-        identifier = span.attrs.get("id")
-        if not identifier:
-            continue
+    content = "\n\n".join(contents.values())
 
-        # The span id must start with a valid prefix
-        if not re.search(prefix_regex, identifier):
-            continue
+    # If the content is unchanged, record the commit and don't parse again
+    content_hash = generate_sha256({"files": files, "content": content})
+    if not force and content_hash == article.content_hash:
+        Article.objects.filter(uuid=article.uuid).update(content_commit=commit)
+        update_job_meta(skipped=True, reason="content unchanged", hash=content_hash)
+        return
 
-        # The span id must have all lowercase, no special characters or spaces
-        if re.search("[^A-Za-z0-9-]+", identifier):
-            continue
+    # Render, validate, and extract spans in one pass - don't continue if not valid
+    parsed = parse_markdown(content)
+    if not parsed.valid:
+        print("Markdown is invalid: %s" % parsed.message)
+        update_job_meta(skipped=True, reason=parsed.message)
+        return
 
-        # If the question is valid, get or create
-        if "question" in identifier:
-            question, created = Question.objects.get_or_create(text=identifier)
-            article.question_set.add(question)
+    # Questions, examples, and content are updated together
+    with transaction.atomic():
+        update_questions(article, parsed.questions)
+        update_examples(article, parsed.examples)
+        article.text = content
+        article.rendered = parsed.html
+        article.renderer = renderer_version
+        article.content_hash = content_hash
+        article.content_commit = commit
+        article.save(
+            update_fields=[
+                "text",
+                "rendered",
+                "renderer",
+                "content_hash",
+                "content_commit",
+                "modified",
+            ]
+        )
 
-        # Examples are added only if found following code section
-        else:
-            code = span.find_next("code")
-            if code:
-                cleaned = remove_language(code.text)
-                code.string.replace_with(cleaned)
-                example, created = Example.objects.get_or_create(
-                    text=identifier, code=cleaned
-                )
-                article.example_set.add(example)
-
-    article.text = content
-    article.save()
     article.update_tags()
+    update_job_meta(skipped=False, hash=content_hash)
+
+
+def update_questions(article, questions):
+    """reconcile the questions stored for an article with a list of parsed
+       question identifiers. New questions are created in bulk, questions no
+       longer found are deleted with one query, and unchanged questions
+       are left alone (keeping their uuid and created date).
+    """
+    existing = set(article.question_set.values_list("text", flat=True))
+    article.question_set.exclude(text__in=questions).delete()
+    Question.objects.bulk_create(
+        [
+            Question(article=article, text=text)
+            for text in questions
+            if text not in existing
+        ]
+    )
+
+
+def update_examples(article, examples):
+    """reconcile the examples stored for an article with a dictionary of
+       parsed example identifiers, code, and language. As with questions, new
+       examples are created in bulk and removed examples deleted in one query.
+       Examples with changed code are highlighted again and updated in bulk,
+       and the rest are left alone.
+    """
+    existing = {
+        example.text: example
+        for example in article.example_set.filter(text__in=list(examples))
+    }
+    article.example_set.exclude(text__in=list(examples)).delete()
+
+    created = []
+    changed = []
+    for text, parsed in examples.items():
+        example = existing.get(text)
+        if example is None:
+            example = Example(article=article, text=text, **parsed)
+            example.render()
+            created.append(example)
+        elif example.code != parsed["code"] or example.language != parsed["language"]:
+            example.code = parsed["code"]
+            example.language = parsed["language"]
+            example.render()
+            example.modified = timezone.now()
+            changed.append(example)
+
+    Example.objects.bulk_create(created)
+    Example.objects.bulk_update(
+        changed, ["code", "language", "rendered", "renderer", "modified"]
+    )
 
 
 def test_markdown(text):
     """Given markdown text from a post, ensure that the spans are correct.
        If not, return to user with an error message.
     """
-    html = markdown.markdown(text)
+    parsed = parse_markdown(text)
+    return parsed.valid, parsed.message
 
-    # Convert to beautiful soup
-    soup = BeautifulSoup(html, "lxml")
 
-    # Supported span prefixes
-    prefixes = ["question", "example"]
-    prefix_regex = "^(%s)" % "|".join(prefixes)
+def add_article_tags(article):
+    """add tags from the repository topics, if the repository metadata
+       includes them, otherwise request the topics.
+    """
+    topics = article.repo.get("topics")
+    if topics:
+        for topic in topics:
+            tag, created = Tag.objects.get_or_create(tag=topic)
+            article.tags.add(tag)
+        article.update_search()
+    else:
+        article.update_tags()
 
-    # Ensure that each span is all lowercase, with no extra characters
-    for span in soup.find_all("span"):
 
-        # The span is required to have an id
-        identifier = span.attrs.get("id")
-        if not identifier:
-            return False, "Span %s is missing an identifier." % span
+def fail_job(message):
+    """record that a job failed with a message for the user, and return it
+    """
+    print(message)
+    update_job_meta(status="failed", message=message)
+    return {"status": "failed", "message": message}
 
-        # The span id must start with a valid prefix
-        if not re.search(prefix_regex, identifier):
-            return False, "Span %s does not start with %s" % (identifier, prefix_regex)
 
-        # The span id must have all lowercase, no special characters or spaces
-        if re.search("[^A-Za-z0-9-]+", identifier):
-            return (
-                False,
-                "Span %s is invalid: can only have lowercase and '-'" % identifier,
+def create_article(user_id, namespace, term, summary, template_uuid):
+    """create a new article repository from a template, along with its
+       webhook and article, and then submit the first update. This runs as a
+       job, and progress is recorded in the job meta for the user to poll
+       (see article_job_status).
+    """
+    from askci.apps.main.github import copy_repository_template
+
+    try:
+        user = User.objects.get(id=user_id)
+        template = TemplateRepository.objects.get(uuid=template_uuid)
+    except (User.DoesNotExist, TemplateRepository.DoesNotExist):
+        return fail_job("The user or template no longer exists.")
+
+    repository = "%s/askci-term-%s" % (namespace, term)
+    update_job_meta(status="started", message="Generating %s" % repository)
+    repo = copy_repository_template(
+        user=user, template=template.repo, repository=repository, description=summary
+    )
+    if not repo:
+        return fail_job(
+            "There was an error creating %s. Make sure that the template %s "
+            "organization is authenticated with the application here."
+            % (repository, template.repo)
+        )
+
+    return add_article(user, repo, term, template, summary)
+
+
+def import_repository(user_id, full_name, template_uuid):
+    """import an existing repository (<owner>/askci-term-<term>) as an
+       article, as a job. As with create_article, progress is recorded in
+       the job meta.
+    """
+    from askci.apps.main.github import get_repo
+
+    try:
+        user = User.objects.get(id=user_id)
+        template = TemplateRepository.objects.get(uuid=template_uuid)
+    except (User.DoesNotExist, TemplateRepository.DoesNotExist):
+        return fail_job("The user or template no longer exists.")
+
+    update_job_meta(status="started", message="Retrieving %s" % full_name)
+    username, reponame = full_name.split("/")
+    repo = get_repo(user, reponame=reponame, username=username)
+
+    # Check again for webhook permission
+    if not repo or not repo.get("permissions", {}).get("admin"):
+        return fail_job("You must be an admin on %s to import it." % full_name)
+
+    # The term is the end of the repository name
+    term = reponame.replace("askci-term-", "")
+    return add_article(user, repo, term, template, repo["description"])
+
+
+def add_article(user, repo, term, template, summary):
+    """create the webhook and article for a new or imported repository, add
+       tags, and submit the first update. Two repositories (e.g., in one
+       bulk import) can have the same term, so the article is created for
+       a term by one job at a time, and a webhook created for a term that
+       was taken meanwhile is deleted.
+    """
+    from askci.apps.main.github import create_webhook, delete_webhook
+
+    lock = get_redis().lock(
+        "%s:%s" % (article_term_prefix, term), timeout=ARTICLE_JOB_TIMEOUT
+    )
+    if not lock.acquire(blocking=False):
+        return fail_job("An article for %s is already being created." % term)
+
+    try:
+        if Article.objects.filter(name=term).exists():
+            return fail_job("An article for %s already exists." % term)
+
+        # One webhook for push/deployment, pull request, and repository events
+        update_job_meta(message="Creating webhook for %s" % repo["full_name"])
+        secret = str(uuid.uuid4())
+        webhook = create_webhook(user, repo, secret)
+        if not webhook or "errors" in webhook:
+            return fail_job("Errors: %s" % (webhook or {}).get("errors"))
+
+        # namespace defaults to library
+        try:
+            article = Article.objects.create(
+                name=term,
+                template=template,
+                owner=user,
+                secret=secret,
+                webhook={"askci": webhook},
+                repo=repo,
+                summary=summary,
+            )
+        except IntegrityError:
+            delete_webhook(user, repo, webhook["id"])
+            return fail_job("An article for %s already exists." % term)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            print("Lock for creating %s expired" % term)
+
+    update_job_meta(message="Adding tags to %s" % term)
+    add_article_tags(article)
+
+    # Run the first update
+    django_rq.enqueue(update_article, article_uuid=article.uuid)
+    update_job_meta(
+        status="finished", message="%s has been created!" % term, article=term
+    )
+    return {"status": "finished", "article": term}
+
+
+def import_repositories(user_id, full_names, template_uuid, job_id=None):
+    """import many repositories as articles (e.g., onboarding an organization)
+       in a chain of jobs, each importing the next BULK_IMPORT_BATCH_SIZE
+       repositories with a pool of BULK_IMPORT_WORKERS threads. Progress is
+       kept in the meta of the first job (job_id for the rest of the chain),
+       which the status page polls. If the user's GitHub budget runs low,
+       the next job is scheduled for after the rate limit resets.
+    """
+    from askci.apps.main.github import get_user_budget_wait
+
+    queue = django_rq.get_queue("default")
+    job = queue.fetch_job(job_id) if job_id else get_current_job()
+    if job is None:
+        print("The job for importing %s repositories expired" % len(full_names))
+        return
+
+    try:
+        user = User.objects.get(id=user_id)
+    except User.DoesNotExist:
+        update_job_meta(job, status="failed", message="The user no longer exists.")
+        return
+
+    results = job.meta.get("repos", {})
+    remaining = [name for name in full_names if name not in results]
+    kwargs = dict(
+        user_id=user_id,
+        full_names=full_names,
+        template_uuid=template_uuid,
+        job_id=job.id,
+    )
+
+    # Only start a batch if the budget allows, otherwise continue later
+    wait = get_user_budget_wait(user)
+    if wait:
+        update_job_meta(
+            job,
+            status="deferred",
+            message="Imported %s of %s repositories, the rest will be "
+            "imported when the GitHub rate limit resets."
+            % (len(results), len(full_names)),
+        )
+        scheduler = django_rq.get_scheduler("default")
+        scheduler.enqueue_in(
+            timedelta(seconds=wait),
+            import_repositories,
+            timeout=ARTICLE_JOB_TIMEOUT,
+            **kwargs
+        )
+        return
+
+    update_job_meta(
+        job,
+        status="started",
+        message="Importing %s repositories" % len(full_names),
+        repos=results,
+    )
+
+    batch = remaining[:BULK_IMPORT_BATCH_SIZE]
+    with ThreadPoolExecutor(max_workers=BULK_IMPORT_WORKERS) as pool:
+        futures = {
+            pool.submit(import_repository_thread, user_id, name, template_uuid): name
+            for name in batch
+        }
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            update_job_meta(
+                job,
+                message="Imported %s of %s repositories"
+                % (len(results), len(full_names)),
+                repos=results,
             )
 
-    return True, "Valid"
+    # Continue with the next batch in a new job
+    if len(remaining) > len(batch):
+        django_rq.enqueue(
+            import_repositories, job_timeout=ARTICLE_JOB_TIMEOUT, **kwargs
+        )
+        return
+
+    failed = [
+        name for name, result in results.items() if result["status"] != "finished"
+    ]
+    update_job_meta(
+        job,
+        status="finished",
+        message="Imported %s of %s repositories"
+        % (len(results) - len(failed), len(full_names)),
+    )
+    return results
+
+
+def import_repository_thread(user_id, full_name, template_uuid):
+    """import a repository in a thread of import_repositories. Errors are
+       returned as a failed result, and the thread closes its database
+       connection when it's done.
+    """
+    try:
+        return import_repository(user_id, full_name, template_uuid)
+    except Exception as exc:
+        return {"status": "failed", "message": str(exc)}
+    finally:
+        connection.close()
@@ -17,6 +17,7 @@ urlpatterns = [
     url(r"^reviews/?$", views.all_reviews, name="all_reviews"),
     url(r"^examples/?$", views.all_examples, name="all_examples"),
     url(r"^export/?$", views.export, name="export"),
+    url(r"^github/status/?$", views.github_status, name="github_status"),
     url(r"^update/templates/?$", views.update_templates, name="update_templates"),
     url(r"^e/article/(?P<name>.+)/?$", views.article_details, name="article_details"),
     url(
@@ -25,6 +26,12 @@ urlpatterns = [
     url(r"^tag/(?P<tag>.+)/?$", views.tag_details, name="tag_details"),
     url(r"^article/new/?$", views.new_article, name="new_article"),
     url(r"^article/import/?$", views.import_article, name="import_article"),
+    url(r"^article/job/(?P<job_id>[^/]+)/?$", views.article_job, name="article_job"),
+    url(
+        r"^article/job/(?P<job_id>[^/]+)/status/?$",
+        views.article_job_status,
+        name="article_job_status",
+    ),
     url(r"^question/new/?$", views.new_question, name="new_question"),
     url(r"^question/new/(?P<name>.+)/?$", views.new_question, name="new_question"),
     url(r"^download/repos/csv/?$", views.download_repos_csv, name="download_repos_csv"),
@@ -73,15 +73,27 @@ def init_template_repos():
 def generate_sha256(content):
     """Generate a sha256 hex digest for a string or dictionary. If it's a 
        dictionary, we dump as a string (with sorted keys) and encode for utf-8.
-       The intended use is for a Schema Hash
+       The intended use is for a Schema Hash, or the content hash of an article.
 
        Parameters
        ==========
        content: a string or dict to be hashed.
     """
     if isinstance(content, dict):
-        content = json.dumps(content, sort_keys=True).encode("utf-8")
-    return "sha256:%s" % hashlib.sha256().hexdigest()
+        content = json.dumps(content, sort_keys=True)
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return "sha256:%s" % hashlib.sha256(content).hexdigest()
+
+
+# Redis
+
+
+def get_redis():
+    """return a connection to the redis server used by the task queue, for
+       small pieces of shared state (caches, counters, and locks).
+    """
+    return django_rq.get_connection("default")
 
 
 # Pagination
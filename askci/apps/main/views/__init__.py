@@ -1,6 +1,8 @@
 from .articles import (
     all_articles,
     article_details,
+    article_job,
+    article_job_status,
     delete_article,
     import_article,
     new_article,
@@ -13,6 +15,7 @@ from .download import (
     download_article_text,
     export,
 )
+from .github import github_status
 from .questions import new_question
 from .reviews import all_reviews
 from .tags import all_tags, tag_details
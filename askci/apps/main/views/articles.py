@@ -11,24 +11,36 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.shortcuts import render, redirect
-from django.http import Http404, JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
 from django.urls import reverse
 from ratelimit.decorators import ratelimit
 
-from askci.apps.main.models import Article, PullRequest, Tag, TemplateRepository
+from askci.apps.main.models import (
+    Article,
+    PullRequest,
+    Tag,
+    TemplateRepository,
+    TemplateUpdate,
+)
+from askci.apps.main.search import invalidate_search_cache
 from askci.apps.main.utils import lowercase_cleaned_name, get_paginated
-from askci.apps.main.tasks import update_article, test_markdown
+from askci.apps.main.tasks import (
+    create_article,
+    import_repositories,
+    import_repository,
+    test_markdown,
+)
 from askci.settings import (
+    ARTICLE_JOB_RESULT_TTL,
+    ARTICLE_JOB_TIMEOUT,
     VIEW_RATE_LIMIT as rl_rate,
     VIEW_RATE_LIMIT_BLOCK as rl_block,
     USER_ARTICLES_LIMIT,
 )
 from askci.apps.main.github import (
-    copy_repository_template,
-    create_webhook,
     delete_webhook,
     get_admin_namespaces,
-    get_repo,
     get_repository_topics,
     list_repos,
     request_review,
@@ -38,7 +50,9 @@ from askci.apps.main.github import (
 import django_rq
 import os
 import re
-import uuid
+
+# Repositories to import are streamed into the page here, see import_article
+import_repos_marker = "<!-- askci:import-repos -->"
 
 ## Article Actions
 
@@ -137,8 +151,10 @@ def delete_article(request, name):
 
     # First delete webhooks, only works for owner
     for webhook_name, webhook in article.webhook.items():
-        delete_webhook(request.user, article.repo, webhook["id"])
+        if "id" in webhook:
+            delete_webhook(request.user, article.repo, webhook["id"])
     article.delete()
+    invalidate_search_cache()
     messages.info(request, "%s has been deleted." % article.name)
     return redirect("index")
 
@@ -158,76 +174,20 @@ def new_article(request):
         namespace = request.POST.get("namespace")
         summary = request.POST.get("summary")
         term = lowercase_cleaned_name(request.POST.get("term"))
-        repository = "askci-term-%s" % term
-        repository = os.path.join(namespace, repository)
 
         # We only have one template repo to start (used as fork)
         template = TemplateRepository.objects.last()
 
-        # Generate the template repository
-        repo = copy_repository_template(
-            user=request.user,
-            template=template.repo,
-            repository=repository,
-            description=summary,
-        )
-
-        # The article repo was created!
-        if repo:
-
-            # Generate the webhooks (push/deployment and pull request)
-            secret = str(uuid.uuid4())
-
-            webhook = create_webhook(request.user, repo, secret)
-            webhook_pr = create_webhook(
-                request.user, repo, secret, events=["pull_request"]
-            )
-
-            # repository event triggered when renamed, etc.
-            webhook_repo = create_webhook(
-                request.user, repo, secret, events=["repository"]
-            )
-
-            # Save both to webhooks json object
-            webhooks = {
-                "push-deploy": webhook,
-                "pull_request": webhook_pr,
-                "repository": webhook_repo,
-            }
-
-            if "errors" in webhook:
-                messages.info(request, "Errors: %s" % webhook["errors"])
-                return redirect("index")
-
-            # namespace defaults to library
-            article = Article.objects.create(
-                name=term,
-                template=template,
-                owner=request.user,
-                secret=secret,
-                webhook=webhooks,
-                repo=repo,
-                summary=summary,
-            )
-
-            add_article_tags(article)
-
-            # Run the first task
-            res = django_rq.enqueue(update_article, article_uuid=article.uuid)
-
-            messages.info(
-                request,
-                "%s has been created! Refresh the page for updated content." % term,
-            )
-            return redirect(reverse("article_details", args=[article.name]))
-
-        # if we get here, there was an error
-        messages.warning(
+        # The repository, webhook, and article are created in a job
+        job = enqueue_article_job(
             request,
-            "There was an error creating %s. " % repository,
-            "Make sure that the template %s organization " % template.repo,
-            "is authenticated with the application here.",
+            create_article,
+            namespace=namespace,
+            term=term,
+            summary=summary,
+            template_uuid=template.uuid,
         )
+        return redirect(reverse("article_job", args=[job.id]))
 
     # username/orgs that the user has admin for (to create webhook)
     namespaces = get_admin_namespaces(request.user)
@@ -264,18 +224,6 @@ def has_articles_opening(request):
     return True
 
 
-def add_article_tags(article):
-    """if topics are included in the webhook, add them to the article
-    """
-    if "topics" in article.webhook:
-        if len(article.webhook["topics"]) > 0:
-            for tag in webhook["topics"]:
-                article.tags.add(tag)
-            article.save()
-    else:
-        article.update_tags()
-
-
 # Import an existing article repository
 
 
@@ -290,22 +238,25 @@ def import_article(request):
 
     template_names = [t.name for t in TemplateRepository.objects.all()]
     if request.method == "GET":
-        repos = list_repos(request.user)
         templates = TemplateRepository.objects.all()
+        articles = set(Article.objects.values_list("repo_id", flat=True))
 
-        # Filter down to those with admin permission (webhook create)
-        repos = [r for r in repos if r["permissions"]["admin"]]
-
-        articles = [x.repo["id"] for x in Article.objects.all()]
-        repos = [
+        # Filter to those with admin permission (webhook create) as they arrive
+        repos = (
             repo
-            for repo in repos
-            if repo["id"] not in articles
+            for repo in list_repos(request.user)
+            if repo["permissions"]["admin"]
+            and repo["id"] not in articles
             and repo["name"].startswith("askci-term")
             and repo["name"] not in template_names
-        ]
-        context = {"repos": repos, "templates": templates}
-        return render(request, "articles/import_article.html", context)
+        )
+
+        # The page is rendered with the first repo, and the rest are streamed
+        first = next(repos, None)
+        context = {"repos": [first] if first else [], "templates": templates}
+        page = render_to_string("articles/import_article.html", context, request)
+        head, _, tail = page.partition(import_repos_marker)
+        return StreamingHttpResponse(stream_import_repos(head, repos, tail))
 
     elif request.method == "POST":
 
@@ -316,80 +267,127 @@ def import_article(request):
             if re.search("^REPO_", x)
         ]
         template_uuid = request.POST.get("template")
-        secret = uuid.uuid4().__str__()
 
         try:
             template = TemplateRepository.objects.get(uuid=template_uuid)
-        except Template.DoesNotExist:
+        except TemplateRepository.DoesNotExist:
             messages.error(request, "That template doesn't exist")
             return redirect("import_article")
 
-        if len(repos) > 0:
+        # Don't import more than the user has openings for
+        openings = (
+            USER_ARTICLES_LIMIT - Article.objects.filter(owner=request.user).count()
+        )
+        if len(repos) > openings:
+            messages.info(
+                request, "Only the first %s repositories will be imported." % openings
+            )
+            repos = repos[:openings]
 
-            # Always just take the first one
-            username, reponame = repos[0].split("/")
+        # A single repository is imported like a new article
+        if len(repos) == 1:
+            job = enqueue_article_job(
+                request,
+                import_repository,
+                full_name=repos[0],
+                template_uuid=template.uuid,
+            )
+            return redirect(reverse("article_job", args=[job.id]))
 
-            # Retrieve the repo fully
-            repo = get_repo(request.user, reponame=reponame, username=username)
+        # Many repositories are imported in parallel, in a chain of jobs
+        elif len(repos) > 1:
+            job = enqueue_article_job(
+                request,
+                import_repositories,
+                full_names=repos,
+                template_uuid=template.uuid,
+            )
+            return redirect(reverse("article_job", args=[job.id]))
 
-            # Check again for webhook permission
-            if not repo["permissions"]["admin"]:
-                messages.info(
-                    request, "You must be an admin on the repository to import it."
-                )
-                return redirect("import_article")
+    return redirect("index")
 
-            # Generate the webhook
-            secret = str(uuid.uuid4())
 
-            webhook = create_webhook(request.user, repo, secret)
-            webhook_pr = create_webhook(
-                request.user, repo, secret, events=["pull_request"]
-            )
+# Article creation and import jobs
 
-            # repository event triggered when renamed, etc.
-            webhook_repo = create_webhook(
-                request.user, repo, secret, events=["repository"]
-            )
 
-            # Save both to webhooks json object
-            webhooks = {
-                "push-deploy": webhook,
-                "pull_request": webhook_pr,
-                "repository": webhook_repo,
-            }
-
-            # If there are errors, or can't create, don't continue
-            if "errors" in webhook:
-                messages.info(request, "Errors: %s" % webhook["errors"])
-                return redirect("import_article")
-
-            # The term is the end of the repository name
-            term = reponame.replace("askci-term-", "")
-
-            # namespace defaults to library
-            article = Article.objects.create(
-                name=term,
-                owner=request.user,
-                secret=secret,
-                webhook=webhooks,
-                repo=repo,
-                template=template,
-                summary=repo["description"],
-            )
+def enqueue_article_job(request, func, **kwargs):
+    """enqueue a job to create or import an article for the user. The user
+       is recorded in the job meta, so only they can see its progress, and
+       the job is kept for ARTICLE_JOB_RESULT_TTL seconds (an import of many
+       repositories continues in other jobs, and reports progress here).
+    """
+    job = django_rq.get_queue("default").enqueue_call(
+        func=func,
+        kwargs=dict(user_id=request.user.id, **kwargs),
+        timeout=ARTICLE_JOB_TIMEOUT,
+        result_ttl=ARTICLE_JOB_RESULT_TTL,
+        meta={"user": request.user.id, "status": "queued"},
+    )
+    messages.info(request, "Your article is being created.")
+    return job
+
+
+def get_article_job(request, job_id):
+    """return a job to create or import an article, if it was started by the
+       user, otherwise raise Http404
+    """
+    job = django_rq.get_queue("default").fetch_job(job_id)
+    if job is None or job.meta.get("user") != request.user.id:
+        raise Http404
+    return job
 
-            add_article_tags(article)
 
-            # Run the first task
-            res = django_rq.enqueue(update_article, article_uuid=article.uuid)
+@login_required
+def article_job(request, job_id):
+    """show the progress of creating or importing an article, which the page
+       polls from article_job_status.
+    """
+    job = get_article_job(request, job_id)
+    return render(request, "articles/article_job.html", {"job_id": job.id})
 
-            messages.info(
-                request,
-                "%s has been created! Refresh the page for updated content." % term,
-            )
-            return redirect(reverse("article_details", args=[article.name]))
 
-    return redirect("index")
+@login_required
+def article_job_status(request, job_id):
+    """return the status and message of a job to create or import an article,
+       and the article url when it's finished. A job to import many
+       repositories also returns the result for each.
+    """
+    job = get_article_job(request, job_id)
+    status = job.meta.get("status", job.get_status())
+    message = job.meta.get("message", "Waiting for a worker.")
+    if job.is_failed:
+        status = "failed"
+        message = "There was an error creating the article."
+
+    response = {"status": status, "message": message}
+    if "repos" in job.meta:
+        response["repos"] = job.meta["repos"]
+        for result in response["repos"].values():
+            if result.get("article"):
+                result["url"] = reverse("article_details", args=[result["article"]])
+    if job.meta.get("article"):
+        response["url"] = reverse("article_details", args=[job.meta["article"]])
+    return JsonResponse(response)
+
+
+def stream_import_repos(head, repos, tail):
+    """yield the import page in parts: the page up to the list of repos,
+       each remaining repo as the next page of results arrives from GitHub,
+       and then the rest of the page. The response status was already sent,
+       so an error from GitHub (e.g., a rate limit) on a later page is shown
+       as a notice, and the rest of the page is still sent.
+    """
+    yield head
+    try:
+        for repo in repos:
+            yield render_to_string("articles/import_repo.html", {"repo": repo})
+    except Exception as exc:
+        print("Error listing repositories to import: %s" % exc)
+        yield (
+            '<p class="alert alert-danger">There was an error listing more '
+            "repositories from GitHub, please try again later.</p>"
+        )
+    yield tail
 
 
 @ratelimit(key="ip", rate=rl_rate, block=rl_block)
@@ -399,28 +397,29 @@ def update_templates(request):
        would be triggered manually by a staff or admin in the case that
        a template repository is changed
     """
-    from askci.apps.main.github import update_template
+    from askci.apps.main.github import start_template_update
 
     if not request.user.is_staff or not request.user.is_superuser:
         messages.info(request, "You don't have permission to perform this action.")
+        return redirect("index")
 
     if request.method == "POST":
         template_uuids = request.POST.getlist("templates")
         article_names = request.POST.getlist("articles")
 
-        print(template_uuids)
-        print(article_names)
-
-        # Look up templates and articles
-        templates = TemplateRepository.objects.filter(uuid__in=template_uuids)
-        articles = Article.objects.filter(name__in=article_names)
-
-        count = 0
-        for article in articles:
-            if article.template in templates:
-                res = django_rq.enqueue(update_template, article=article.name)
-                count += 1
-        messages.info(request, "%s terms requested for update." % count)
+        # Articles that use one of the selected templates are updated in a job
+        articles = Article.objects.filter(
+            name__in=article_names, template__uuid__in=template_uuids
+        ).values_list("name", flat=True)
+        update = TemplateUpdate.objects.create(
+            owner=request.user, articles=list(articles)
+        )
+        start_template_update(update.uuid)
+        messages.info(
+            request,
+            "%s terms requested for update, see template update %s in the admin."
+            % (len(update.articles), update.uuid),
+        )
 
     # GET is down here
     articles = Article.objects.order_by("-name")
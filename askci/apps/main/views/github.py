@@ -0,0 +1,65 @@
+"""
+
+Copyright (C) 2019-2020 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+
+from django.contrib.auth.decorators import login_required
+from django.contrib import messages
+from django.shortcuts import render, redirect
+from ratelimit.decorators import ratelimit
+from social_django.models import UserSocialAuth
+
+from askci.apps.main.github.budget import get_budget_key, list_budgets
+from askci.apps.main.github.client import get_latency_stats
+from askci.apps.main.github.utils import get_cache_stats
+from askci.apps.main.tasks import get_article_update_stats
+from askci.settings import (
+    GITHUB_BUDGET_RESERVE,
+    VIEW_RATE_LIMIT as rl_rate,
+    VIEW_RATE_LIMIT_BLOCK as rl_block,
+)
+
+from datetime import datetime
+
+
+@ratelimit(key="ip", rate=rl_rate, block=rl_block)
+@login_required
+def github_status(request):
+    """A staff view to show the GitHub rate limit budget for each token,
+       along with the cache and latency of requests to GitHub, and how
+       many article updates were coalesced.
+    """
+    if not request.user.is_staff:
+        messages.info(request, "You don't have permission to see this page.")
+        return redirect("index")
+
+    # Budgets are stored by token hash, so we match them back to users
+    usernames = {}
+    for auth in UserSocialAuth.objects.filter(
+        provider__in=["github", "github-readonly"]
+    ).select_related("user"):
+        if auth.access_token:
+            usernames[get_budget_key(auth.access_token)] = auth.user.username
+
+    budgets = []
+    for key, budget in list_budgets().items():
+        budget["username"] = usernames.get(key, "unknown")
+        budget["reset"] = datetime.fromtimestamp(budget["reset"])
+        budget["deferred"] = budget["remaining"] <= GITHUB_BUDGET_RESERVE
+        budgets.append(budget)
+    budgets.sort(key=lambda x: x["remaining"])
+
+    latency = sorted(get_latency_stats().items(), key=lambda x: -x[1]["seconds"])
+    context = {
+        "budgets": budgets,
+        "reserve": GITHUB_BUDGET_RESERVE,
+        "cache": get_cache_stats(),
+        "latency": latency,
+        "updates": get_article_update_stats(),
+    }
+    return render(request, "github/status.html", context)
@@ -10,12 +10,13 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser, BaseUserManager
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.db import models
 
 from rest_framework.authtoken.models import Token
-from askci.apps.users.utils import get_usertoken
+from social_django.models import UserSocialAuth
+from askci.apps.users.utils import clear_social_auth, get_usertoken
 
 import os
 
@@ -125,3 +126,13 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
     """
     if created:
         Token.objects.create(user=instance)
+
+
+@receiver(post_save, sender=UserSocialAuth)
+@receiver(post_delete, sender=UserSocialAuth)
+def clear_credentials(sender, instance=None, **kwargs):
+    """Clear cached credentials when a social auth association is created,
+       updated (e.g., a new token) or removed.
+    """
+    if UserSocialAuth.user.is_cached(instance):
+        clear_social_auth(instance.user)
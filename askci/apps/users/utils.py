@@ -35,3 +35,25 @@ def get_usertoken(user):
     except Token.DoesNotExist:
         token = Token.objects.create(user=user)
     return token.key
+
+
+def get_social_auth(user):
+    """return a list of social auth credentials for a user, in the order
+       they were created. The list is kept on the user for the request, so
+       permission checks in templates don't query again. Credentials hold
+       access tokens, so they aren't cached anywhere else.
+    """
+    if user.is_anonymous:
+        return []
+
+    credentials = getattr(user, "_social_auth", None)
+    if credentials is None:
+        credentials = list(user.social_auth.order_by("id"))
+        user._social_auth = credentials
+    return credentials
+
+
+def clear_social_auth(user):
+    """clear the credentials kept on a user, when an association changes
+    """
+    user.__dict__.pop("_social_auth", None)
@@ -18,6 +18,7 @@ from django.contrib.auth.decorators import login_required
 from social_core.backends.github import GithubOAuth2
 
 from ratelimit.decorators import ratelimit
+from askci.apps.users.utils import get_social_auth
 from askci.settings import VIEW_RATE_LIMIT as rl_rate, VIEW_RATE_LIMIT_BLOCK as rl_block
 
 
@@ -93,23 +94,12 @@ class GithubReadOnlyOAuth2(GithubOAuth2):
 
 
 def get_credentials(user, provider):
-    """return one or more credentials, or None"""
-    credential = None
-    if not user.is_anonymous:
-        try:
-            # Case 1: one credential
-            credential = user.social_auth.get(provider=provider)
-            return credential
-
-        # Credential doesn't exist
-        except user.social_auth.model.DoesNotExist:
-            return credential
-
-        except:
-            # Case 2: more than one credential for the provider
-            credential = user.social_auth.filter(provider=provider)
-            if len(credential) > 0:
-                return credential.last()
+    """return the credential for a provider (the last if there is more than
+       one), or None
+    """
+    credentials = [x for x in get_social_auth(user) if x.provider == provider]
+    if credentials:
+        return credentials[-1]
 
 
 ## Ensure equivalent email across accounts
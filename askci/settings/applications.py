@@ -17,6 +17,7 @@ INSTALLED_APPS = [
     "django.contrib.sitemaps",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "django_user_agents",
     "askci.apps.api",
     "askci.apps.base",
@@ -68,11 +68,73 @@ NODE_TWITTER = os.environ.get("NODE_TWITTER", "askcyberinfra").strip('"')
 # Repository Templates
 REPO_TEMPLATES = ["https://github.com/hpsee/askci-template-term"]
 
+# Base urls for the GitHub API and raw content. Point these at a local fake
+# (python manage.py fake_github) to run or benchmark without GitHub
+GITHUB_API_BASE = os.environ.get("GITHUB_API_BASE", "https://api.github.com").strip('"')
+GITHUB_RAW_BASE = os.environ.get(
+    "GITHUB_RAW_BASE", "https://raw.githubusercontent.com"
+).strip('"')
+
+# GitHub requests: timeout (seconds) for each request, retries for server
+# errors and secondary rate limits (waiting backoff * 2^attempt seconds, up
+# to a maximum wait), and the size of the connection pool for each process
+GITHUB_REQUEST_TIMEOUT = 10
+GITHUB_REQUEST_RETRIES = 3
+GITHUB_REQUEST_BACKOFF = 1
+GITHUB_REQUEST_MAX_WAIT = 60
+GITHUB_POOL_SIZE = 10
+
+# Web requests don't retry GitHub when it would wait longer than this (seconds)
+GITHUB_REQUEST_INTERACTIVE_WAIT = 2
+
+# Background jobs defer themselves until the rate limit resets when a user's
+# remaining GitHub requests drop below this reserve (kept for interactive use)
+GITHUB_BUDGET_RESERVE = 500
+
+# Maximum size (bytes) of a raw file fetched for an article, and number
+# of files fetched at once
+GITHUB_RAW_MAX_SIZE = 1024 * 1024
+GITHUB_RAW_WORKERS = 4
+
+# Number of pages of a GitHub list (e.g., repositories) to fetch at once
+GITHUB_PAGE_WORKERS = 4
+
+# Seconds to keep a cached GitHub response (with its ETag / Last-Modified)
+# for conditional requests. A 304 reuses the body and is free for rate limits
+GITHUB_CACHE_TTL = 60 * 60 * 24 * 7
+
+# Pygments style for highlighting example code, re-highlight existing
+# examples after changing with python manage.py highlight_examples
+EXAMPLE_HIGHLIGHT_STYLE = "default"
+
 # Permissions and Views
 
 # disable all webhooks to update terms from repos
 DISABLE_WEBHOOKS = False
 
+# Seconds to wait after a push before updating an article (a push in this
+# time replaces the pending update), and the longest an update can hold
+# the article lock
+ARTICLE_UPDATE_DELAY = 10
+ARTICLE_UPDATE_LOCK_TIMEOUT = 60 * 10
+
+# Webhook deliveries wait in a redis stream for consume_webhooks, capped
+# (approximately) at this many entries
+WEBHOOK_STREAM_MAXLEN = 10000
+
+# Seconds to remember a delivery id (a redelivery in this time is dropped)
+# and the number of deliveries kept (compressed) to replay_webhooks
+WEBHOOK_DELIVERY_TTL = 60 * 60 * 24 * 3
+WEBHOOK_LOG_MAXLEN = 50000
+
+# A delivery that fails with a transient error (e.g., the database is down)
+# is retried after a delay (seconds), up to a number of deliveries, and
+# deliveries left pending by a consumer (e.g., one that died) are claimed by
+# another after they have been idle this many seconds
+WEBHOOK_RETRY_DELAY = 5
+WEBHOOK_MAX_DELIVERIES = 10
+WEBHOOK_CLAIM_IDLE = 60 * 5
+
 # DATABASE
 
 # https://docs.djangoproject.com/en/1.9/ref/settings/#databases
@@ -87,10 +149,53 @@ DATABASES = {
     }
 }
 
+# Postgres text search configuration used to index and search articles
+SEARCH_CONFIG = "english"
+
+# Trigram similarity thresholds for fuzzy search and "did you mean" (0 to 1),
+# and the most words of a query to find suggestions for
+SEARCH_SIMILARITY = 0.2
+SEARCH_WORD_SIMILARITY = 0.5
+SEARCH_SUGGESTION_WORDS = 5
+
+# Search results for each page, and the most results that can be paged through
+SEARCH_PAGE_SIZE = 25
+SEARCH_MAX_RESULTS = 1000
+
+# Search results are cached (seconds) until articles change, and concurrent
+# searches for the same results wait up to the lock timeout (seconds) for one
+SEARCH_CACHE_TTL = 3600
+SEARCH_CACHE_LOCK_TIMEOUT = 5
+
+# Typeahead: the most suggestions returned (and kept for each prefix), the
+# longest prefix indexed, seconds to wait after a change before rebuilding
+# the index, and the rate limit for the endpoint (one request per keystroke)
+SEARCH_SUGGEST_LIMIT = 10
+SEARCH_SUGGEST_PREFIX_LENGTH = 20
+SEARCH_SUGGEST_DELAY = 30
+SEARCH_SUGGEST_RATE_LIMIT = "1000/1h"
+
 # Limits
 
 USER_ARTICLES_LIMIT = 100
 
+# Number of repositories imported at once when importing many
+BULK_IMPORT_WORKERS = 4
+
+# Repositories imported by each job when importing many (the jobs are chained)
+BULK_IMPORT_BATCH_SIZE = 20
+
+# Seconds that a job to create or import articles can run, and that its
+# progress is kept for the status page
+ARTICLE_JOB_TIMEOUT = 900
+ARTICLE_JOB_RESULT_TTL = 86400
+
+# Template updates send dispatches to articles in batches (saving progress
+# after each) with a number of threads, and at most a rate per minute
+TEMPLATE_UPDATE_BATCH_SIZE = 20
+TEMPLATE_UPDATE_WORKERS = 4
+TEMPLATE_UPDATE_RATE = 60
+
 VIEW_RATE_LIMIT = (
     "50/1d"
 )  # The rate limit for each view, django-ratelimit, "50 per day per ipaddress)
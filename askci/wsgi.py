@@ -9,6 +9,10 @@ application = get_wsgi_application()
 import django_rq
 from datetime import datetime
 from askci.apps.main.utils import backup_db, init_template_repos
+from askci.apps.main.github.client import set_interactive
+
+# Requests to GitHub from views don't wait long to be retried
+set_interactive()
 
 # Set up scheduler
 scheduler = django_rq.get_scheduler("default")
@@ -6,6 +6,8 @@ python manage.py makemigrations api
 python manage.py makemigrations main
 python manage.py makemigrations
 python manage.py migrate
+python manage.py index_repos
+python manage.py index_articles
 python manage.py collectstatic --noinput
 service cron start
 